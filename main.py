@@ -25,6 +25,12 @@ parser.add_argument(
     choices=["request_handler", "data_processor"],
     default=["request_handler", "data_processor"],
 )
+parser.add_argument(
+    "--handler_mode",
+    help="run the request handler with threads or on an asyncio event loop, default to `handler_mode` in config",
+    choices=["thread", "async"],
+    default=None,
+)
 ARGS = parser.parse_args()
 
 
@@ -32,13 +38,21 @@ ARGS = parser.parse_args()
 def main():
     LOG = get_module_logger(__file__)
 
-    from qlib_server.request_handler import RequestHandler
+    from qlib_server.config import C
     from qlib_server.data_processor import DataProcessor
 
     LOG.info("QLibServer starting...")
     threads = []
     if "request_handler" in ARGS.module:
-        threads.append(RequestHandler())
+        if (ARGS.handler_mode or C.handler_mode) == "async":
+            # the dependencies of the async mode are optional
+            from qlib_server.async_request_handler import AsyncRequestHandler
+
+            threads.append(AsyncRequestHandler())
+        else:
+            from qlib_server.request_handler import RequestHandler
+
+            threads.append(RequestHandler())
     if "data_processor" in ARGS.module:
         threads.append(DataProcessor())
 
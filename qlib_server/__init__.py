@@ -1,3 +1,3 @@
 # Copyright (c) Microsoft Corporation.
 # Licensed under the MIT License.
-__version__ = "0.2.0"
\ No newline at end of file
+__version__ = "0.2.0"
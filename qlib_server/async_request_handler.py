@@ -0,0 +1,238 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+from __future__ import division
+from __future__ import print_function
+
+import time
+import json
+import asyncio
+import threading
+
+import uvicorn
+import socketio
+import aio_pika
+import redis.asyncio as aioredis
+
+from .config import C
+from .codec import load_raw, PacketJSON, RawJSON
+from .data_index import DataIndex
+from .feature_stream import FeatureStream
+from .hash_ring import ProcessorRing
+from .utils import (
+    DATA_UPDATE_CHANNEL,
+    DATA_VERSION_KEY,
+    GET_RESULT_MEMO_SCRIPT,
+    RESULT_MEMO_PREFIX,
+    get_task_queue,
+    get_task_queues,
+    get_task_uri,
+    get_reply_queue,
+)
+from .request_handler import RequestListener, RequestResponder
+
+from qlib.log import get_module_logger
+
+time_logger = get_module_logger("AsyncRequestHandler")
+
+
+class AsyncRequestHandler(threading.Thread):
+    """Asyncio request handler class.
+
+    An alternative of `RequestHandler` with the same events and payloads(`C.handler_mode` is "async").
+    The listener and the responder run on one event loop in this thread:
+
+        - socket.io is served by `python-socketio` AsyncServer as an ASGI app with `uvicorn`
+        - the tasks are published and the messages are consumed with `aio-pika`
+        - the data update notifications are subscribed with `redis.asyncio`
+
+    So a handler can hold thousands of mostly idle connections without a thread for each of them.
+    """
+
+    def __init__(self):
+        super(AsyncRequestHandler, self).__init__()
+        self.logger = get_module_logger(self.__class__.__name__)
+        client_manager = None
+        if C.socketio_message_queue:
+            client_manager = socketio.AsyncRedisManager(C.socketio_message_queue)
+        self.sio = socketio.AsyncServer(
+            async_mode="asgi", ping_interval=C.flask_ping_interval, json=PacketJSON, client_manager=client_manager
+        )
+        self.app = socketio.ASGIApp(self.sio)
+        self.data_index = DataIndex()
+        self.processor_ring = ProcessorRing()
+        self.channel = None
+        self.redis = None
+        self.get_result_memo_script = None
+        # the references of the background tasks, so they are not garbage collected before they are done
+        self.background_tasks = set()
+
+        self.sio.on("connect", self.on_connect)
+        self.sio.on("disconnect", self.on_disconnect)
+        for request_type in ["calendar", "instrument", "feature", "feature_stream"]:
+            self.sio.on("%s_request" % request_type, self.get_request_callback(request_type))
+
+    async def on_connect(self, sid, environ):
+        """Callback function when the server accepted a connection from a client."""
+        time_logger.debug("Connection established at %f" % time.time())
+        self.logger.info("Connection established with client %s" % sid)
+
+    async def on_disconnect(self, sid, *args):
+        """Callback function when the server terminated a connection from a client."""
+        time_logger.debug("Connection destructed at %f" % time.time())
+        self.logger.info("Connection finished with client %s" % sid)
+
+    def get_request_callback(self, request_type):
+        async def request_callback(sid, request_body):
+            await self.on_request_received(request_type, sid, request_body)
+
+        return request_callback
+
+    async def on_request_received(self, request_type, sid, request_body):
+        """Callback function when the server received a request from a client.
+
+        Answer it with the in-process indexes if possible, otherwise publish it as a task.
+        """
+        time_logger.debug("receive %s request at %f" % (request_type, time.time()))
+        body = json.loads(request_body["body"])
+        self.logger.info("Received %s request from client: %.200s" % (request_type, body))
+        try:
+            RequestListener.check_version(request_body["head"]["version"])
+        except Exception as e:
+            self.logger.error(e)
+            await self.respond(request_type, [sid], None, 1, str(e))
+            return
+
+        loop = asyncio.get_running_loop()
+        result = await loop.run_in_executor(None, self.data_index.query, request_type, body)
+        if result is not None:
+            time_logger.debug("respond %s request from index at %f" % (request_type, time.time()))
+            await self.respond(request_type, [sid], result)
+            return
+
+        self.logger.info("Publish %s task to rabbitmq" % request_type)
+        task_uri = await loop.run_in_executor(None, get_task_uri, request_type, body)
+        if C.result_memo_ttl and request_type in ["calendar", "instrument"]:
+            memo = await self.get_result_memo_script(keys=[DATA_VERSION_KEY], args=[RESULT_MEMO_PREFIX, task_uri])
+            if memo is not None:
+                time_logger.debug("respond %s request from memo at %f" % (request_type, time.time()))
+                await self.respond(request_type, [sid], RawJSON(memo.decode("utf-8")))
+                return
+        room = task_uri if request_type != "feature_stream" else None
+        if room is not None:
+            await self.sio.enter_room(sid, room)
+        lane = await loop.run_in_executor(None, self.data_index.route, request_type, body) if C.task_routing else None
+        task_queue = get_task_queue(lane)
+        if C.processor_routing:
+            task_queue = await loop.run_in_executor(
+                None, self.processor_ring.route, task_queue, request_type, body, task_uri
+            )
+        try:
+            await self.channel.default_exchange.publish(
+                aio_pika.Message(body=RequestListener.encode_task(request_type, body, sid, task_uri)),
+                routing_key=task_queue,
+            )
+        except Exception as e:
+            # the client is responded with an error instead of waiting for the response forever
+            self.logger.error("Failed to publish the %s task of client %s: %.200s" % (request_type, sid, e))
+            await self.respond(request_type, [sid], None, 1, "Failed to publish the request, please retry later", room)
+
+    async def on_message(self, message):
+        """Callback function when a task is finished and a published message is received."""
+        async with message.process():
+            time_logger.debug("receive message from queue at %f" % time.time())
+            mheader, mdata = RequestResponder.decode_message(message.body)
+            mtype = mheader["type"]
+            self.logger.info("Receive %s message for %d clients" % (mtype, len(mheader["ssids"])))
+            if mtype in ["calendar", "instrument", "feature"]:
+                await self.respond(
+                    mtype, mheader["ssids"], mdata, mheader["status"], mheader["detailed_info"], mheader.get("room")
+                )
+            elif mtype == "feature_stream":
+                for ssid in mheader["ssids"]:
+                    if mheader["status"] != 0:
+                        await self.respond(mtype, [ssid], None, mheader["status"], mheader["detailed_info"])
+                    else:
+                        self.create_background_task(self.stream_features(ssid, load_raw(mdata)))
+            else:
+                self.logger.warning("Unrecognized message type!")
+
+    def create_background_task(self, coro):
+        task = asyncio.create_task(coro)
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
+        return task
+
+    async def respond(self, message_type, client_ssids, data, status=0, detailed_info=None, room=None):
+        """Respond to clients with data, the response is the same as `RequestResponder.respond`."""
+        response = {"result": data, "status": status, "detailed_info": detailed_info}
+        self.logger.info("Send %s response to clients %s" % (message_type, client_ssids))
+        await self.sio.emit("%s_response" % message_type, response, to=list(client_ssids))
+        if room is not None:
+            for ssid in client_ssids:
+                await self.sio.leave_room(ssid, room)
+
+    async def stream_features(self, ssid, data):
+        """Stream the features to a client, the stream is the same as `RequestResponder.stream_features`."""
+        self.logger.info("Stream features to client %s" % ssid)
+        loop = asyncio.get_running_loop()
+        window = asyncio.Semaphore(C.stream_window)
+        stream = FeatureStream(data)
+        chunks = iter(stream)
+        try:
+            seq = 0
+            # the chunks are read from the disk in the executor
+            while True:
+                chunk = await loop.run_in_executor(None, next, chunks, None)
+                if chunk is None:
+                    break
+                try:
+                    await asyncio.wait_for(window.acquire(), C.stream_ack_timeout)
+                except asyncio.TimeoutError:
+                    raise TimeoutError("The client doesn't acknowledge the chunks of the stream")
+                await self.sio.emit(
+                    "feature_stream_chunk",
+                    {"seq": seq, "data": chunk},
+                    to=ssid,
+                    callback=lambda *args: window.release(),
+                )
+                seq += 1
+        except Exception as e:
+            self.logger.exception(f"Error while streaming features %.200s" % e)
+            await loop.run_in_executor(None, chunks.close)
+            await self.respond("feature_stream", [ssid], None, 1, str(e))
+        else:
+            await self.respond("feature_stream", [ssid], stream.summary)
+
+    async def subscribe_data_update(self):
+        """Reload the indexes every time the data is updated."""
+        pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        await pubsub.subscribe(DATA_UPDATE_CHANNEL)
+        loop = asyncio.get_running_loop()
+        async for _ in pubsub.listen():
+            self.logger.info("data updated, reload the indexes")
+            await loop.run_in_executor(None, self.data_index.reload)
+
+    async def serve(self):
+        self.redis = aioredis.StrictRedis(host=C.redis_host, port=C.redis_port, db=C.redis_task_db)
+        self.get_result_memo_script = self.redis.register_script(GET_RESULT_MEMO_SCRIPT)
+        connection = await aio_pika.connect_robust(
+            host=C.queue_host, login=C.queue_user, password=C.queue_pwd, heartbeat=C.queue_heartbeat
+        )
+        async with connection:
+            # with publisher confirms, the publishing coroutines wait for their confirms concurrently
+            self.channel = await connection.channel(publisher_confirms=C.queue_confirm)
+            await self.channel.set_qos(prefetch_count=C.max_concurrency)
+            for task_queue in get_task_queues():
+                await self.channel.declare_queue(task_queue, durable=True)
+            message_queue = await self.channel.declare_queue(get_reply_queue(), durable=True)
+            await message_queue.consume(self.on_message)
+
+            await asyncio.get_running_loop().run_in_executor(None, self.data_index.load)
+            server = uvicorn.Server(uvicorn.Config(self.app, host="0.0.0.0", port=C.flask_port))
+            await asyncio.gather(server.serve(), self.subscribe_data_update())
+
+    def run(self):
+        """Start the event loop serving socket.io, rabbitmq and redis."""
+        self.logger.info("async request handler module start...")
+        asyncio.run(self.serve())
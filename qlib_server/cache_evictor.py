@@ -0,0 +1,177 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+from __future__ import division
+from __future__ import print_function
+
+import pickle
+from pathlib import Path
+from collections import namedtuple
+
+import redis_lock
+
+from .config import C
+from .utils import get_redis_connection, incr_metric
+from .coalescing import INFLIGHT_KEY, unregister_superset_cache
+from .cache_index import get_cache_index, get_cache_dir
+
+from qlib.config import C as QC
+from qlib.log import get_module_logger
+
+# a cache file and its meta/index files
+CacheEntry = namedtuple("CacheEntry", ["kind", "path", "uri", "size", "files", "last_visit", "visits"])
+
+
+class CacheEvictor(object):
+    """Evict the least recently(or frequently) used caches when the caches exceed the quotas.
+
+    The expression caches(features_cache) and the dataset caches(dataset_cache) of a freq share the quotas:
+
+        - `C.cache_quota_mb`: the total size(MB) of the cache files
+        - `C.cache_quota_inodes`: the total number of the cache files
+
+    The last visit time and the visit count of a cache are recorded in its meta file by qlib every time
+    it is read, and in the cache index by the processors. The caches are listed from the cache index
+    if `C.cache_index_path` is set, otherwise from the cache directories. A dataset cache is never evicted
+    while it is read or written(its redis lock is held), or while the feature task generating it is being
+    processed.
+
+    The expression caches are read by qlib without any lock, so they could be removed in the middle of a read.
+    They count towards the quotas, but are only evicted if `evict_expressions`(`C.evict_expression_caches`)
+    is set, which is safe only when no processor is serving meanwhile.
+    """
+
+    def __init__(self, freq="day", quota_mb=None, quota_inodes=None, policy=None, evict_expressions=None):
+        self.logger = get_module_logger(self.__class__.__name__)
+        self.freq = freq
+        self.evict_expressions = C.evict_expression_caches if evict_expressions is None else evict_expressions
+        self.quota_mb = C.cache_quota_mb if quota_mb is None else quota_mb
+        self.quota_inodes = C.cache_quota_inodes if quota_inodes is None else quota_inodes
+        self.policy = C.cache_eviction_policy if policy is None else policy
+        self.cache_index = get_cache_index()
+        if self.policy not in ["lru", "lfu"]:
+            raise ValueError("Unknown cache eviction policy: %s" % self.policy)
+
+    @staticmethod
+    def read_entry(kind, path):
+        files = [p for p in [path, path.with_suffix(".meta"), path.with_suffix(".index")] if p.exists()]
+        size = sum(p.stat().st_size for p in files)
+        try:
+            with path.with_suffix(".meta").open("rb") as f:
+                meta = pickle.load(f)["meta"]
+            last_visit, visits = float(meta["last_visit"]), int(meta["visits"])
+        except Exception:
+            # the meta file is broken, the cache is not usable either
+            last_visit, visits = path.stat().st_mtime, 0
+        return CacheEntry(kind, path, path.name, size, len(files), last_visit, visits)
+
+    def scan(self):
+        """Get all the cache entries of the freq."""
+        if self.cache_index is not None:
+            self.cache_index.sync(self.freq)
+            return [
+                CacheEntry(e.kind, Path(e.path), Path(e.path).name, e.size, e.files, e.last_access, e.visits)
+                for kind in ["expression", "dataset"]
+                for e in self.cache_index.entries(kind, self.freq)
+            ]
+
+        entries = []
+        for kind, pattern in [("expression", "*/*"), ("dataset", "*")]:
+            cache_dir = get_cache_dir(kind, self.freq)
+            if cache_dir is None:
+                # no cache mechanism
+                continue
+            for path in cache_dir.glob(pattern):
+                if "." in path.name or not path.is_file():
+                    continue
+                try:
+                    entries.append(self.read_entry(kind, path))
+                except FileNotFoundError:
+                    # removed meanwhile
+                    continue
+        return entries
+
+    def get_lock_name(self, entry):
+        """Get the name of the redis lock of the cache, the same as the one used by qlib."""
+        return f"{str(QC.dpm.get_data_uri(self.freq))}:{entry.kind}-{entry.uri}"
+
+    def get_eviction_order(self, entries):
+        if self.policy == "lfu":
+            return sorted(entries, key=lambda e: (e.visits, e.last_visit))
+        return sorted(entries, key=lambda e: e.last_visit)
+
+    def evict_entry(self, entry):
+        """Remove the cache files if the cache is not in use and has not been visited since it was listed.
+
+        :return: whether the cache is evicted
+        """
+        redis_t = get_redis_connection()
+        if entry.kind == "dataset" and redis_t.hexists(INFLIGHT_KEY, entry.uri):
+            return False
+        if self.cache_index is not None:
+            # the expression caches read by qlib are only recorded in their meta files
+            current = self.cache_index.update_entry(entry.kind, self.freq, entry.path)
+            if current is not None and current.last_access > entry.last_visit:
+                return False
+        # the readers and the writers of the cache hold the write lock
+        lock = redis_lock.Lock(redis_t, f"{self.get_lock_name(entry)}-wlock", expire=60)
+        if not lock.acquire(blocking=False):
+            return False
+        try:
+            for p in [entry.path, entry.path.with_suffix(".meta"), entry.path.with_suffix(".index")]:
+                if p.exists():
+                    p.unlink()
+        finally:
+            lock.release()
+        if self.cache_index is not None:
+            self.cache_index.remove(entry.kind, self.freq, self.cache_index.get_key(entry.kind, entry.path))
+        if entry.kind == "dataset":
+            unregister_superset_cache(entry.uri)
+        return True
+
+    def evict(self):
+        """Evict the caches until they are within the quotas.
+
+        :return: the evicted cache entries
+        """
+        if not self.quota_mb and not self.quota_inodes:
+            return []
+        entries = self.scan()
+        total_size = sum(e.size for e in entries)
+        total_files = sum(e.files for e in entries)
+
+        def exceeded():
+            return (self.quota_mb and total_size > self.quota_mb * 1024 * 1024) or (
+                self.quota_inodes and total_files > self.quota_inodes
+            )
+
+        evicted = []
+        skipped = 0
+        for entry in self.get_eviction_order(entries):
+            if not exceeded():
+                break
+            if entry.kind == "expression" and not self.evict_expressions:
+                continue
+            if not self.evict_entry(entry):
+                skipped += 1
+                continue
+            self.logger.info(
+                "evict %s cache %s(%d bytes, last visit %f)" % (entry.kind, entry.path, entry.size, entry.last_visit)
+            )
+            evicted.append(entry)
+            total_size -= entry.size
+            total_files -= entry.files
+
+        if evicted:
+            incr_metric("cache_evicted", len(evicted))
+            incr_metric("cache_evicted_bytes", sum(e.size for e in evicted))
+        self.logger.info(
+            f"evict caches."
+            f"\n\t evicted cache length: {len(evicted)}"
+            f"\n\t skipped cache length(in use or visited): {skipped}"
+            f"\n\t remaining size: {total_size}"
+            f"\n\t remaining files: {total_files}"
+        )
+        if exceeded():
+            self.logger.warning("the caches still exceed the quotas after eviction")
+        return evicted
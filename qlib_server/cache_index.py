@@ -0,0 +1,259 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+from __future__ import division
+from __future__ import print_function
+
+import time
+import pickle
+import sqlite3
+import contextlib
+from pathlib import Path
+from collections import namedtuple
+
+from .config import C
+
+from qlib.log import get_module_logger
+
+# an indexed cache file, `key` is the path of the cache file relative to the cache directory of its kind and freq
+IndexEntry = namedtuple(
+    "IndexEntry",
+    ["kind", "freq", "key", "path", "size", "files", "last_update", "last_access", "visits", "watermark"],
+)
+
+_CACHE_INDEX = None
+
+# the file systems on which the SQLite WAL mode is unsafe, since it relies on the shared memory of the host
+NETWORK_FILE_SYSTEMS = {"nfs", "nfs4", "cifs", "smb3", "smbfs", "fuse.sshfs", "glusterfs", "ceph", "lustre", "9p"}
+
+
+def get_file_system(path):
+    """get the type of the file system `path` is on, None if it's unknown(not linux)."""
+    try:
+        with open("/proc/mounts") as f:
+            mounts = [line.split()[1:3] for line in f]
+    except OSError:
+        return None
+    path = str(Path(path).resolve())
+    fs_type, matched = None, ""
+    for mount_point, mount_type in mounts:
+        # the mount points are escaped in /proc/mounts
+        mount_point = mount_point.replace("\\040", " ")
+        if (path == mount_point or path.startswith(mount_point.rstrip("/") + "/")) and len(mount_point) >= len(matched):
+            fs_type, matched = mount_type, mount_point
+    return fs_type
+
+
+def get_cache_dir(kind, freq):
+    """get the cache directory of the expression caches or the dataset caches, None if there is no cache mechanism."""
+    from qlib.data.data import ExpressionD, DatasetD
+
+    provider = ExpressionD if kind == "expression" else DatasetD
+    try:
+        return Path(provider.get_cache_dir(freq))
+    except AttributeError:
+        return None
+
+
+def get_cache_index():
+    """get the cache index of the process, None if `C.cache_index_path` is not set."""
+    global _CACHE_INDEX
+    if not C.cache_index_path:
+        return None
+    if _CACHE_INDEX is None:
+        _CACHE_INDEX = CacheIndex(C.cache_index_path)
+    return _CACHE_INDEX
+
+
+class CacheIndex(object):
+    """A SQLite index of the expression caches and the dataset caches.
+
+    The index records the size, the last update(the last date of the calendar the cache is updated to),
+    the last access, the visits and the watermark of the source data of every cache file, so the updater,
+    the evictor and the processors query it instead of walking the cache directories.
+
+    The index is local to a host: it should be on a local disk, and it's shared only by the processes of the
+    host. The processors and the updater of the host record the caches they write or access. The caches
+    written by others(e.g. the expression caches written by qlib or by the other hosts) are found by `sync`,
+    which only lists the directories whose mtime has changed since the last sync.
+
+    .. note:: The index is opened in the WAL mode, which is unsafe on the network file systems. If the index
+        is on one, it falls back to the rollback journal, which is slower.
+    """
+
+    def __init__(self, path):
+        self.logger = get_module_logger(self.__class__.__name__)
+        self.path = Path(path).expanduser()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        fs_type = get_file_system(self.path.parent)
+        journal_mode = "WAL"
+        if fs_type in NETWORK_FILE_SYSTEMS:
+            self.logger.warning(
+                "The cache index %s is on %s, which doesn't support the WAL mode of SQLite. "
+                "Please set `cache_index_path` to a path on a local disk." % (self.path, fs_type)
+            )
+            journal_mode = "DELETE"
+        with self.connect() as conn:
+            conn.execute("PRAGMA journal_mode=%s" % journal_mode)
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache_entries ("
+                "kind TEXT, freq TEXT, key TEXT, path TEXT, size INTEGER, files INTEGER, last_update TEXT, "
+                "last_access REAL, visits INTEGER, watermark REAL, PRIMARY KEY (kind, freq, key))"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache_dirs ("
+                "kind TEXT, freq TEXT, path TEXT, mtime REAL, PRIMARY KEY (kind, freq, path))"
+            )
+
+    @contextlib.contextmanager
+    def connect(self):
+        # a connection for each operation, so the index can be used by different threads and processes
+        conn = sqlite3.connect(str(self.path), timeout=60)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    @staticmethod
+    def get_key(kind, path):
+        path = Path(path)
+        return f"{path.parent.name}/{path.name}" if kind == "expression" else path.name
+
+    @staticmethod
+    def read_entry(kind, freq, path):
+        """Read the entry of a cache file from the disk, FileNotFoundError is raised if it doesn't exist."""
+        path = Path(path)
+        files = [p for p in [path, path.with_suffix(".meta"), path.with_suffix(".index")] if p.exists()]
+        if path not in files:
+            raise FileNotFoundError(path)
+        size = sum(p.stat().st_size for p in files)
+        try:
+            with path.with_suffix(".meta").open("rb") as f:
+                meta = pickle.load(f)
+            last_update = meta["info"].get("last_update")
+            last_access, visits = float(meta["meta"]["last_visit"]), int(meta["meta"]["visits"])
+        except Exception:
+            # the meta file is broken or being written
+            last_update, last_access, visits = None, path.stat().st_mtime, 0
+        return IndexEntry(
+            kind,
+            freq,
+            CacheIndex.get_key(kind, path),
+            str(path),
+            size,
+            len(files),
+            last_update,
+            last_access,
+            visits,
+            None,
+        )
+
+    def update_entry(self, kind, freq, path):
+        """Index a cache file with its current state on the disk, the entry is removed if it doesn't exist.
+
+        :return: the entry, None if the cache file doesn't exist
+        """
+        try:
+            entry = self.read_entry(kind, freq, path)
+        except FileNotFoundError:
+            self.remove(kind, freq, self.get_key(kind, path))
+            return None
+        with self.connect() as conn:
+            conn.execute(
+                "INSERT INTO cache_entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (kind, freq, key) DO UPDATE SET path = excluded.path, size = excluded.size, "
+                "files = excluded.files, last_update = excluded.last_update, "
+                "last_access = MAX(last_access, excluded.last_access), visits = MAX(visits, excluded.visits)",
+                entry,
+            )
+        return self.get(kind, freq, entry.key)
+
+    def record_access(self, kind, freq, path):
+        """Record an access of a cache file."""
+        with self.connect() as conn:
+            updated = conn.execute(
+                "UPDATE cache_entries SET last_access = ?, visits = visits + 1 WHERE kind = ? AND freq = ? AND key = ?",
+                (time.time(), kind, freq, self.get_key(kind, path)),
+            ).rowcount
+        if not updated:
+            self.update_entry(kind, freq, path)
+
+    def set_watermark(self, kind, freq, key, watermark, last_update=None):
+        """Record the watermark of the raw data the cache is updated with.
+
+        :param last_update: the cache is indexed as updated to `last_update` if it is given
+        """
+        with self.connect() as conn:
+            conn.execute(
+                "UPDATE cache_entries SET watermark = ?, last_update = COALESCE(?, last_update) "
+                "WHERE kind = ? AND freq = ? AND key = ?",
+                (watermark, last_update, kind, freq, key),
+            )
+
+    def remove(self, kind, freq, key):
+        with self.connect() as conn:
+            conn.execute("DELETE FROM cache_entries WHERE kind = ? AND freq = ? AND key = ?", (kind, freq, key))
+
+    def get(self, kind, freq, key):
+        with self.connect() as conn:
+            row = conn.execute(
+                "SELECT * FROM cache_entries WHERE kind = ? AND freq = ? AND key = ?", (kind, freq, key)
+            ).fetchone()
+        return None if row is None else IndexEntry(*row)
+
+    def entries(self, kind, freq):
+        with self.connect() as conn:
+            rows = conn.execute("SELECT * FROM cache_entries WHERE kind = ? AND freq = ?", (kind, freq)).fetchall()
+        return [IndexEntry(*row) for row in rows]
+
+    def sync(self, freq):
+        """Index the cache files added or removed by others since the last sync.
+
+        Only the directories whose mtime has changed are listed, the first sync lists all of them.
+
+        :return: the number of the directories listed
+        """
+        listed = 0
+        for kind in ["expression", "dataset"]:
+            cache_dir = get_cache_dir(kind, freq)
+            if cache_dir is None or not cache_dir.exists():
+                continue
+            # the expression caches are in the directories of their instruments
+            dirs = [p for p in cache_dir.iterdir() if p.is_dir()] if kind == "expression" else [cache_dir]
+            with self.connect() as conn:
+                known = dict(
+                    conn.execute("SELECT path, mtime FROM cache_dirs WHERE kind = ? AND freq = ?", (kind, freq))
+                )
+            for d in dirs:
+                mtime = d.stat().st_mtime
+                if known.pop(str(d), None) == mtime:
+                    continue
+                self.sync_dir(kind, freq, d)
+                listed += 1
+                with self.connect() as conn:
+                    conn.execute("INSERT OR REPLACE INTO cache_dirs VALUES (?, ?, ?, ?)", (kind, freq, str(d), mtime))
+            # the removed directories
+            for d in known:
+                self.sync_dir(kind, freq, Path(d))
+                with self.connect() as conn:
+                    conn.execute(
+                        "DELETE FROM cache_dirs WHERE kind = ? AND freq = ? AND path = ?", (kind, freq, str(d))
+                    )
+        return listed
+
+    def sync_dir(self, kind, freq, d):
+        prefix = f"{d.name}/" if kind == "expression" else ""
+        with self.connect() as conn:
+            rows = conn.execute(
+                "SELECT key FROM cache_entries WHERE kind = ? AND freq = ? AND substr(key, 1, ?) = ?",
+                (kind, freq, len(prefix), prefix),
+            ).fetchall()
+        indexed = {key for key, in rows}
+        existing = set()
+        if d.exists():
+            existing = {prefix + p.name for p in d.iterdir() if "." not in p.name and p.is_file()}
+        for key in existing - indexed:
+            self.update_entry(kind, freq, d.joinpath(Path(key).name))
+        for key in indexed - existing:
+            self.remove(kind, freq, key)
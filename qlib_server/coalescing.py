@@ -0,0 +1,255 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+from __future__ import division
+from __future__ import print_function
+
+import time
+import json
+
+from .config import C
+from .utils import get_redis_connection, get_task_lease_key, get_task_parked_key
+
+from .dataset_cache import get_dataset_cache_path
+
+from qlib.utils import normalize_cache_fields
+from qlib.data.data import DatasetD
+from qlib.data.cache import DiskDatasetCache
+
+# the hash of the feature tasks being processed, the dataset cache uri -> the task uri and args of the task
+INFLIGHT_KEY = "qlib_server:inflight_features"
+# the hash of the dataset caches which may include the features of other requests,
+# the dataset cache uri -> the args of the feature task generating it
+SUPERSET_CACHES_KEY = "qlib_server:superset_dataset_caches"
+
+
+def get_field_index_key(key, freq, field):
+    """get the set of the uris in the registry `key` of which the features of `freq` include `field`."""
+    return "%s:%s:field:%s" % (key, freq, field)
+
+
+def get_registered_key(key, freq):
+    """get the sorted set of the uris in the registry `key` of `freq` scored by the time they are used."""
+    return "%s:%s" % (key, freq)
+
+
+def index_entry(pipe, key, uri, entry):
+    """Index an entry of the registry `key` by its normalized fields, so it's found without a scan."""
+    freq = entry["freq"]
+    for field in set(normalize_cache_fields(entry["fields"])):
+        pipe.sadd(get_field_index_key(key, freq, field), uri)
+    pipe.zadd(get_registered_key(key, freq), {uri: time.time()})
+
+
+def unindex_entry(pipe, key, uri, entry):
+    freq = entry["freq"]
+    for field in set(normalize_cache_fields(entry["fields"])):
+        pipe.srem(get_field_index_key(key, freq, field), uri)
+    pipe.zrem(get_registered_key(key, freq), uri)
+
+
+def find_candidates(redis_t, key, fields, freq):
+    """Find the entries of the registry `key` which include all the `fields` of `freq`.
+
+    :return: dict of uri -> entry
+    """
+    index_keys = [get_field_index_key(key, freq, field) for field in set(normalize_cache_fields(fields))]
+    if not index_keys:
+        return {}
+    uris = sorted(uri.decode() for uri in redis_t.sinter(index_keys))
+    if not uris:
+        return {}
+    entries = redis_t.hmget(key, uris)
+    return {uri: json.loads(entry) for uri, entry in zip(uris, entries) if entry is not None}
+
+
+def register_inflight(cache_uri, task_uri, instruments, fields, freq):
+    """Register a feature task generating the dataset cache `cache_uri`."""
+    entry = {"task_uri": task_uri, "instruments": instruments, "fields": fields, "freq": freq}
+    with get_redis_connection().pipeline() as pipe:
+        pipe.hset(INFLIGHT_KEY, cache_uri, json.dumps(entry))
+        index_entry(pipe, INFLIGHT_KEY, cache_uri, entry)
+        pipe.execute()
+
+
+def unregister_inflight(cache_uri):
+    redis_t = get_redis_connection()
+    entry = redis_t.hget(INFLIGHT_KEY, cache_uri)
+    if entry is None:
+        return
+    with redis_t.pipeline() as pipe:
+        pipe.hdel(INFLIGHT_KEY, cache_uri)
+        unindex_entry(pipe, INFLIGHT_KEY, cache_uri, json.loads(entry))
+        pipe.execute()
+
+
+def is_inflight(cache_uri, task_uri):
+    """Whether the task generating the dataset cache `cache_uri` is still being processed by a living worker."""
+    redis_t = get_redis_connection()
+    # the lease of the task expires if its worker dies
+    return bool(redis_t.hexists(INFLIGHT_KEY, cache_uri) and redis_t.exists(get_task_lease_key(task_uri)))
+
+
+def park_task(cache_uri, task_uri, record):
+    """Park a feature task until the feature task `task_uri` generating the dataset cache `cache_uri` is finished.
+
+    The parked tasks are kept as long as the lease of `task_uri`, and popped by `pop_parked_tasks` to be
+    republished when it's finished.
+
+    :param record: the task to be republished
+    :return: False if the task `task_uri` has been finished meanwhile, then the caller should pop the parked tasks
+    """
+    redis_t = get_redis_connection()
+    key = get_task_parked_key(task_uri)
+    with redis_t.pipeline() as pipe:
+        pipe.rpush(key, json.dumps(record))
+        pipe.pexpire(key, int(C.task_lease_ttl * 1000) * 10)
+        pipe.execute()
+    # the task is unregistered before its parked tasks are popped
+    return is_inflight(cache_uri, task_uri)
+
+
+def pop_parked_tasks(task_uri):
+    """Pop the tasks parked on the task `task_uri`."""
+    key = get_task_parked_key(task_uri)
+    with get_redis_connection().pipeline() as pipe:
+        pipe.lrange(key, 0, -1)
+        pipe.delete(key)
+        records, _ = pipe.execute()
+    return [json.loads(record) for record in records]
+
+
+def covers_instruments(superset, subset, freq):
+    """Whether the dataset cache of the instruments `superset` includes all the data of `subset`.
+
+    :return: "same" if they are the same instruments, "subset" if the data of `subset` can be sliced from
+             the dataset cache of `superset` by instruments, None if it's not covered
+    """
+    if superset == subset:
+        return "same"
+    if isinstance(subset, dict):
+        # the spans of the instruments can't be sliced by instruments
+        return None
+    if isinstance(superset, (list, tuple)):
+        superset_names = set(superset)
+    elif superset.get("market") in C.subset_superset_markets and not superset.get("filter_pipe"):
+        # the spans of the instruments in these markets cover all their data
+        superset_names = set(DatasetD.get_instruments_d(superset, freq))
+    else:
+        return None
+    if set(subset) == superset_names:
+        return "same"
+    if set(subset) < superset_names:
+        return "subset"
+    return None
+
+
+def covers(superset, subset):
+    """Whether the dataset cache of the feature task `superset` includes all the data of `subset`.
+
+    :param superset: dict of instruments, fields and freq
+    :param subset: dict of instruments, fields and freq
+    :return: the same as `covers_instruments`
+    """
+    if superset["freq"] != subset["freq"]:
+        return None
+    if not set(normalize_cache_fields(subset["fields"])) <= set(normalize_cache_fields(superset["fields"])):
+        return None
+    return covers_instruments(superset["instruments"], subset["instruments"], subset["freq"])
+
+
+def find_inflight_superset(cache_uri, instruments, fields, freq):
+    """Find a feature task being processed of which the dataset cache includes all the data of the request.
+
+    Only the tasks including all the fields are looked up in the index of the fields. The tasks with the same
+    instruments are preferred since their dataset caches are used directly.
+
+    :return: (dataset cache uri, task uri, coverage) of the task, None if there is no such task
+    """
+    redis_t = get_redis_connection()
+    request = {"instruments": instruments, "fields": fields, "freq": freq}
+    found = None
+    for uri, entry in find_candidates(redis_t, INFLIGHT_KEY, fields, freq).items():
+        if uri == cache_uri:
+            continue
+        if not redis_t.exists(get_task_lease_key(entry["task_uri"])):
+            # the worker of the task has died, its parked tasks are republished by the worker taking it over
+            unregister_inflight(uri)
+            continue
+        coverage = covers(entry, request)
+        if coverage == "same":
+            return uri, entry["task_uri"], coverage
+        if coverage is not None and found is None:
+            found = (uri, entry["task_uri"], coverage)
+    return found
+
+
+def register_superset_cache(cache_uri, instruments, fields, freq):
+    """Register a generated dataset cache, so the requests covered by it are sliced from it.
+
+    Only the dataset caches of the instrument lists and the markets in `C.subset_superset_markets` are
+    registered, the others can't be sliced by instruments. At most `C.superset_cache_limit` dataset caches
+    of each freq are registered, the least recently used ones are unregistered.
+    """
+    if isinstance(instruments, dict) and (
+        instruments.get("market") not in C.subset_superset_markets or instruments.get("filter_pipe")
+    ):
+        return
+    entry = {"instruments": instruments, "fields": fields, "freq": freq}
+    redis_t = get_redis_connection()
+    with redis_t.pipeline() as pipe:
+        pipe.hset(SUPERSET_CACHES_KEY, cache_uri, json.dumps(entry))
+        index_entry(pipe, SUPERSET_CACHES_KEY, cache_uri, entry)
+        pipe.execute()
+    if C.superset_cache_limit:
+        n_evicted = redis_t.zcard(get_registered_key(SUPERSET_CACHES_KEY, freq)) - C.superset_cache_limit
+        if n_evicted > 0:
+            for uri in redis_t.zrange(get_registered_key(SUPERSET_CACHES_KEY, freq), 0, n_evicted - 1):
+                unregister_superset_cache(uri.decode())
+
+
+def unregister_superset_cache(cache_uri):
+    """Unregister a dataset cache which is removed or no longer used."""
+    redis_t = get_redis_connection()
+    entry = redis_t.hget(SUPERSET_CACHES_KEY, cache_uri)
+    if entry is None:
+        return
+    with redis_t.pipeline() as pipe:
+        pipe.hdel(SUPERSET_CACHES_KEY, cache_uri)
+        unindex_entry(pipe, SUPERSET_CACHES_KEY, cache_uri, json.loads(entry))
+        pipe.execute()
+
+
+def find_superset_cache(cache_uri, instruments, fields, freq):
+    """Find a generated dataset cache which includes all the data of the request.
+
+    The dataset caches with the same instruments are preferred since they are used directly,
+    then the smaller ones since they are sliced faster. Only the dataset caches including all the fields
+    are looked up in the index of the fields, the ones which have been removed are unregistered.
+
+    :return: (dataset cache uri, coverage), None if there is no such dataset cache
+    """
+    redis_t = get_redis_connection()
+    request = {"instruments": instruments, "fields": fields, "freq": freq}
+    found = None
+    for uri, entry in find_candidates(redis_t, SUPERSET_CACHES_KEY, fields, freq).items():
+        if uri == cache_uri:
+            continue
+        coverage = covers(entry, request)
+        if coverage is None:
+            continue
+        cache_path = get_dataset_cache_path(uri, freq)
+        if not DiskDatasetCache.check_cache_exists(cache_path):
+            # the dataset cache has been removed
+            unregister_superset_cache(uri)
+            continue
+        if coverage == "same":
+            found = (uri, coverage, 0)
+            break
+        size = cache_path.stat().st_size
+        if found is None or size < found[2]:
+            found = (uri, coverage, size)
+    if found is None:
+        return None
+    redis_t.zadd(get_registered_key(SUPERSET_CACHES_KEY, freq), {found[0]: time.time()}, xx=True)
+    return found[:2]
@@ -0,0 +1,154 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+from __future__ import division
+from __future__ import print_function
+
+import re
+import json
+import uuid
+import struct
+
+from .config import C
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# The first byte of an encoded message is its format version.
+# The messages of the original json format start with "{", so they are still decoded after upgrading,
+# and the "json" codec keeps encoding them in this format for the processes which are not upgraded yet.
+JSON_VERSION = ord("{")
+MSGPACK_VERSION = 1
+MSGPACK_ZSTD_VERSION = 2
+# the messages of which the data is encoded as json separately from the header
+RELAY_VERSION = 3
+
+CODECS = ["json", "msgpack"]
+
+
+def check_codec(codec):
+    if codec not in CODECS:
+        raise ValueError("Unknown codec %s, it should be one of %s" % (codec, CODECS))
+    if codec == "msgpack" and msgpack is None:
+        raise ImportError("msgpack is required by the msgpack codec, please install it with `pip install msgpack`")
+
+
+def encode(obj, codec=None):
+    """Encode a task or a message published to the queues.
+
+    :param codec: "json" or "msgpack", `C.queue_codec` by default. The msgpack messages larger than
+                  `C.queue_compress_threshold` bytes are compressed with zstd if `zstandard` is installed.
+    :return: bytes starting with the format version
+    """
+    codec = C.queue_codec if codec is None else codec
+    check_codec(codec)
+    if codec == "json":
+        return json.dumps(obj).encode("utf-8")
+    data = msgpack.packb(obj, use_bin_type=True)
+    if zstandard is not None and C.queue_compress_threshold and len(data) > C.queue_compress_threshold:
+        return bytes([MSGPACK_ZSTD_VERSION]) + zstandard.ZstdCompressor().compress(data)
+    return bytes([MSGPACK_VERSION]) + data
+
+
+def decode(data):
+    """Decode a task or a message encoded by `encode` with any codec."""
+    data = bytes(data)
+    version = data[0] if data else JSON_VERSION
+    if version == JSON_VERSION:
+        return json.loads(data.decode("utf-8"))
+    if version == MSGPACK_VERSION:
+        return msgpack.unpackb(data[1:], raw=False)
+    if version == MSGPACK_ZSTD_VERSION:
+        return msgpack.unpackb(zstandard.ZstdDecompressor().decompress(data[1:]), raw=False)
+    raise ValueError("Unknown message format version %d" % version)
+
+
+def encode_message(header, data, codec=None):
+    """Encode a message as its header and data.
+
+    The header is encoded by `encode`. The data is encoded as json, which is sent to the clients as is,
+    so the responder only decodes the header.
+    The "json" codec keeps encoding the messages in the original format(the header with the data in "data"),
+    so the responders which are not upgraded yet can still decode them.
+
+    :param codec: "json" or "msgpack", `C.queue_codec` by default
+    """
+    codec = C.queue_codec if codec is None else codec
+    if codec == "json":
+        return encode(dict(header, data=data), codec)
+    header = encode(header, codec)
+    return bytes([RELAY_VERSION]) + struct.pack(">I", len(header)) + header + json.dumps(data).encode("utf-8")
+
+
+def decode_message(data):
+    """Decode a message encoded by `encode_message` or `encode`.
+
+    :return: (header, data), the data is a `RawJSON` if the message is encoded by `encode_message`
+    """
+    data = memoryview(data)
+    if len(data) and data[0] == RELAY_VERSION:
+        size = struct.unpack(">I", data[1:5])[0]
+        return decode(data[5 : 5 + size]), RawJSON(str(data[5 + size :], "utf-8"))
+    message = decode(data)
+    return message, message.pop("data")
+
+
+class RawJSON(object):
+    """A json value which has been encoded.
+
+    It is spliced into the socket.io packets by `PacketJSON` as is.
+    """
+
+    __slots__ = ["text"]
+
+    def __init__(self, text):
+        self.text = text
+
+    def load(self):
+        return json.loads(self.text)
+
+    def __repr__(self):
+        return "RawJSON(%.200s)" % self.text
+
+
+def load_raw(data):
+    """Get the value of a `RawJSON` or any other value."""
+    return data.load() if isinstance(data, RawJSON) else data
+
+
+class PacketJSON(object):
+    """The json module of the socket.io servers.
+
+    The `RawJSON` values are spliced into the packets without being encoded again, so a message is encoded
+    once no matter how many clients it's emitted to.
+    """
+
+    # the `RawJSON` values are replaced by the placeholders and then the placeholders by the encoded values
+    _PLACEHOLDER = "\0%s:" % uuid.uuid4().hex
+    _PLACEHOLDER_PATTERN = re.compile(r'"\\u0000%s(\d+)"' % _PLACEHOLDER[1:])
+
+    @staticmethod
+    def dumps(obj, **kwargs):
+        raws = []
+
+        def default(o):
+            if isinstance(o, RawJSON):
+                raws.append(o.text)
+                return "%s%d" % (PacketJSON._PLACEHOLDER, len(raws) - 1)
+            raise TypeError("Object of type %s is not JSON serializable" % o.__class__.__name__)
+
+        text = json.dumps(obj, default=default, **kwargs)
+        if not raws:
+            return text
+        return PacketJSON._PLACEHOLDER_PATTERN.sub(lambda m: raws[int(m.group(1))], text)
+
+    @staticmethod
+    def loads(s, **kwargs):
+        return json.loads(s, **kwargs)
@@ -9,15 +9,106 @@ _server_config = {
     "flask_server": "172.23.233.89",
     "flask_port": 9710,
     "flask_ping_interval": 1.0,
+    # "thread": flask-socketio and pika threads, "async": one asyncio event loop(pip install qlib_server[async])
+    "handler_mode": "thread",
+    # the redis url(e.g. "redis://host:6379/2") of the socket.io message queue shared by the request handler nodes,
+    # so any node can respond to the clients connected to the others
+    "socketio_message_queue": None,
+    # the id of the request handler node, "<hostname>:<flask_port>" by default
+    "node_id": None,
     # rabitmq server
     "queue_host": "10.150.144.154",
     "queue_user": "guest",
     "queue_pwd": "guest",
     "task_queue": "my_task_queue",
     "message_queue": "my_message_queue",
+    # rabbitmq heartbeat interval(seconds) and timeout(seconds) of the connections blocked by the broker
+    "queue_heartbeat": 60,
+    "queue_blocked_timeout": 300,
+    # publish messages in transactions, so they are confirmed by the broker in one round trip per batch
+    "queue_confirm": True,
+    # the bounded queue of the publisher thread of the request handler
+    "publisher_queue_size": 10000,
+    "publisher_batch_size": 100,
+    "publisher_put_timeout": 1,
     "max_process": 10,
+    # route the tasks into a light and a heavy lane by their estimated cost(instruments * fields * days),
+    # each lane has its own queue and its own number of worker processes(see docs/server.rst before enabling it)
+    "task_routing": False,
+    "heavy_task_cost": 5000000,
+    "lane_max_process": {"light": 4, "heavy": 6},
+    # route the tasks to the queues of the data processor nodes by consistent hashing of their uris(or their
+    # instruments if `processor_routing_key` is "instruments"), so the identical or overlapping tasks are processed
+    # on the node where their caches are warm. The nodes send heartbeats every `processor_heartbeat` seconds.
+    "processor_routing": False,
+    "processor_routing_key": "task",
+    "processor_node_id": None,
+    "processor_heartbeat": 10,
+    "hash_ring_replicas": 64,
+    # the results of the completed calendar and instrument tasks are memoized for `result_memo_ttl` seconds,
+    # the identical requests are answered by the listener directly, 0 means never
+    "result_memo_ttl": 60,
+    # the feature tasks covered by a feature task being processed or a generated dataset cache(the same fields or
+    # a subset of them, and the same instruments or a subset of the instruments list or of the markets in
+    # `subset_superset_markets`) get their features from its dataset cache instead of computing them,
+    # they are parked until the task being processed is finished without holding a worker
+    "coalesce_features": True,
+    "subset_superset_markets": ["all"],
+    # at most `superset_cache_limit` generated dataset caches of each freq are registered to be coalesced with,
+    # the least recently used ones are unregistered, 0 means no limit
+    "superset_cache_limit": 10000,
+    # the feature tasks whose dataset caches exist and are up to date are answered by the processor directly,
+    # without the deduplication and the task thread
+    "feature_cache_fast_path": True,
+    # the feature tasks with more than `feature_shard_size` instruments are split into shards,
+    # which are processed by `shard_max_process` workers in parallel, 0 means never
+    "feature_shard_size": 200,
+    "shard_max_process": 8,
+    # the time(seconds) a feature task waits for its shards
+    "feature_shard_timeout": 3600,
+    # the streamed features are sent in chunks of `stream_chunk_rows` rows, at most `stream_window` chunks
+    # are sent before they are acknowledged by the client, the stream is aborted if the client doesn't
+    # acknowledge a chunk in `stream_ack_timeout` seconds
+    "stream_chunk_rows": 50000,
+    "stream_window": 8,
+    "stream_ack_timeout": 60,
+    # the codec of the tasks and messages in the queues, "json" or "msgpack"
+    # the msgpack messages larger than `queue_compress_threshold` bytes are compressed with zstd.
+    # With "json" the responders decode and encode the whole messages again, with "msgpack" the data is relayed
+    # to the clients untouched, switch to it after all the processes are upgraded
+    "queue_codec": "json",
+    "queue_compress_threshold": 65536,
+    # the SQLite index of the caches, which is queried instead of walking the cache directories, None disables it.
+    # It must be on a local disk(the WAL mode of SQLite is unsafe on NFS), each host keeps its own index
+    "cache_index_path": "~/.qlib_server/cache_index.db",
+    # the data updater only updates the indexed caches whose raw feature files have been modified since they were
+    # updated, the others are reported as up to date
+    "incremental_update": True,
+    # the number of the processes updating the dataset caches, the dataset caches generating the same missing
+    # expression caches are updated in the same process
+    "dataset_update_workers": 8,
+    # the least recently("lru") or frequently("lfu") used caches are evicted before the caches are updated,
+    # until the cache files of a freq are within `cache_quota_mb` MB and `cache_quota_inodes` files, 0 means no quota
+    "cache_quota_mb": 0,
+    "cache_quota_inodes": 0,
+    "cache_eviction_policy": "lru",
+    # the expression caches are read by qlib without locks, evict them only if no processor serves during the update
+    "evict_expression_caches": False,
+    # data processor workers are recycled after `worker_max_tasks` tasks or
+    # when their RSS exceeds `worker_max_rss` MB, 0 means never
+    "worker_max_tasks": 1000,
+    "worker_max_rss": 4096,
     "max_concurrency": 10,
     "inactivity_timeout": 5,
+    # the lease(seconds) of a task in processing, it is renewed by the worker until the task is finished
+    "task_lease_ttl": 60,
+    # answer calendar requests in the request handler with an in-process index
+    "calendar_fast_path": True,
+    # answer instrument requests without filter_pipe in the request handler with an in-process index
+    "instrument_fast_path": True,
+    # the freqs and markets whose indexes are loaded when the request handler starts
+    "index_freqs": ["day"],
+    "index_markets": ["all"],
     # cache update
     "auto_update": False,
     "update_time": "23:45",
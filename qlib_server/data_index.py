@@ -0,0 +1,261 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+from __future__ import division
+from __future__ import print_function
+
+import json
+import threading
+import numpy as np
+import pandas as pd
+from collections import OrderedDict
+
+from .config import C
+from .codec import RawJSON
+
+from qlib.data import D
+from qlib.data.cache import H
+from qlib.log import get_module_logger
+
+
+def to_int64(t):
+    """Convert a time or an array of times to int64 nanoseconds."""
+    if isinstance(t, str) or not np.iterable(t):
+        return pd.Timestamp(t).to_datetime64().astype("datetime64[ns]").astype(np.int64)
+    return pd.DatetimeIndex(t).values.astype("datetime64[ns]").astype(np.int64)
+
+
+def to_str(values):
+    """Convert an array of int64 nanoseconds to str in the same format as `str(pd.Timestamp)`."""
+    return list(pd.DatetimeIndex(values.astype("datetime64[ns]")).strftime("%Y-%m-%d %H:%M:%S"))
+
+
+class CalendarIndex(object):
+    """In-process calendar index.
+
+    The calendars are loaded once per (freq, future) and kept as sorted int64 arrays,
+    so a calendar request is answered with two binary searches instead of a data processor task.
+    The index should be reset after the data is updated.
+    """
+
+    def __init__(self):
+        self.logger = get_module_logger(self.__class__.__name__)
+        self._lock = threading.Lock()
+        self._calendars = {}
+
+    def load(self, freq, future=False):
+        """Load the calendar of `freq` into the index if it is not loaded yet."""
+        key = (freq, bool(future))
+        if key not in self._calendars:
+            with self._lock:
+                if key not in self._calendars:
+                    self.logger.info("load calendar index of %s(future=%s)" % key)
+                    _calendar = D.calendar(freq=freq, future=future)
+                    self._calendars[key] = (to_int64(_calendar), [str(c) for c in _calendar])
+        return self._calendars[key]
+
+    def locate(self, start_time, end_time, freq, future=False):
+        """Get the [start, end) positions of the time range in the calendar."""
+        values, _ = self.load(freq, future)
+        if start_time == "None":
+            start_time = None
+        if end_time == "None":
+            end_time = None
+        si = 0 if start_time is None else np.searchsorted(values, to_int64(start_time), "left")
+        ei = len(values) if end_time is None else np.searchsorted(values, to_int64(end_time), "right")
+        return int(si), int(ei)
+
+    def calendar(self, start_time, end_time, freq, future=False):
+        """Same as `D.calendar`, but the timestamps are returned as str."""
+        si, ei = self.locate(start_time, end_time, freq, future)
+        return self.load(freq, future)[1][si:ei]
+
+    def reset(self):
+        """Drop the loaded calendars, they will be reloaded on the next request."""
+        with self._lock:
+            self._calendars = {}
+            # the calendars are memory cached by qlib too
+            H["c"].clear()
+
+
+class InstrumentIndex(object):
+    """In-process instrument index.
+
+    The spans of the instruments in a market are loaded once per (market, freq) and kept as int64
+    arrays, so filtering by time range is vectorized. The responses are memoized as encoded json per
+    (market, freq, range, as_list), so a repeated request is a dict lookup and isn't encoded again.
+    Markets with `filter_pipe` are not supported since the filters need the feature data.
+    The index should be reset after the data is updated.
+    """
+
+    def __init__(self, max_responses=1024):
+        self.logger = get_module_logger(self.__class__.__name__)
+        self.max_responses = max_responses
+        self._lock = threading.Lock()
+        self._markets = {}
+        self._responses = OrderedDict()
+
+    @staticmethod
+    def support(instruments):
+        """Whether the instruments config can be answered by the index."""
+        return isinstance(instruments, dict) and "market" in instruments and not instruments.get("filter_pipe")
+
+    def load(self, market, freq):
+        """Load the spans of the instruments in `market` into the index if they are not loaded yet.
+
+        :return: (instrument names, instrument ids, starts, ends) of all the spans
+        """
+        key = (market, freq)
+        if key not in self._markets:
+            with self._lock:
+                if key not in self._markets:
+                    self.logger.info("load instrument index of %s(%s)" % key)
+                    spans = D.list_instruments(D.instruments(market), freq=freq, as_list=False)
+                    names = list(spans)
+                    inst_ids = np.repeat(np.arange(len(names)), [len(t) for t in spans.values()])
+                    starts = to_int64([s for t in spans.values() for s, _ in t])
+                    ends = to_int64([e for t in spans.values() for _, e in t])
+                    self._markets[key] = (names, inst_ids, starts, ends)
+        return self._markets[key]
+
+    def size(self, market, freq):
+        """Get the number of instruments in `market`."""
+        return len(self.load(market, freq)[0])
+
+    def list_instruments(self, instruments, start_time=None, end_time=None, freq="day", as_list=False):
+        """Same as `D.list_instruments`, but the timestamps are returned as str.
+
+        :return: the result encoded as a `RawJSON`
+        """
+        # the equivalent spellings of a time are memoized as the same range
+        start_time = None if start_time in [None, "None"] else int(to_int64(start_time))
+        end_time = None if end_time in [None, "None"] else int(to_int64(end_time))
+        key = (instruments["market"], freq, start_time, end_time, bool(as_list))
+        try:
+            return self._responses[key]
+        except KeyError:
+            pass
+
+        names, inst_ids, starts, ends = self.load(instruments["market"], freq)
+        # the spans have been clipped by the calendar when they are loaded
+        if start_time is not None:
+            starts = np.maximum(starts, start_time)
+        if end_time is not None:
+            ends = np.minimum(ends, end_time)
+        mask = starts <= ends
+        if as_list:
+            result = [names[i] for i in np.unique(inst_ids[mask])]
+        else:
+            result = {}
+            for i, s, e in zip(inst_ids[mask], to_str(starts[mask]), to_str(ends[mask])):
+                result.setdefault(names[i], []).append((s, e))
+        result = RawJSON(json.dumps(result))
+
+        with self._lock:
+            self._responses[key] = result
+            while len(self._responses) > self.max_responses:
+                self._responses.popitem(last=False)
+        return result
+
+    def reset(self):
+        """Drop the loaded markets and responses, they will be reloaded on the next request."""
+        with self._lock:
+            self._markets = {}
+            self._responses = OrderedDict()
+            # the instruments are memory cached by qlib too
+            H["i"].clear()
+
+
+class DataIndex(object):
+    """The in-process indexes answering calendar and instrument requests.
+
+    The indexes of `C.index_freqs` and `C.index_markets` are loaded by `load`, the others are
+    loaded lazily.
+    """
+
+    def __init__(self):
+        self.logger = get_module_logger(self.__class__.__name__)
+        self.calendar_index = CalendarIndex()
+        self.instrument_index = InstrumentIndex()
+
+    def load(self):
+        """Load the indexes of `C.index_freqs` and `C.index_markets`."""
+        for freq in C.index_freqs:
+            try:
+                if C.calendar_fast_path:
+                    self.calendar_index.load(freq)
+                if C.instrument_fast_path:
+                    for market in C.index_markets:
+                        self.instrument_index.load(market, freq)
+            except Exception as e:
+                self.logger.warning("Failed to load the indexes of %s: %s" % (freq, e))
+
+    def reload(self):
+        """Reload the indexes after the data is updated."""
+        self.calendar_index.reset()
+        self.instrument_index.reset()
+        self.load()
+
+    def query(self, task_type, request_body):
+        """Answer a request with the indexes.
+
+        :return: the result of the request, None if the indexes can't answer it
+        """
+        try:
+            if task_type == "calendar" and C.calendar_fast_path:
+                return self.calendar_index.calendar(
+                    request_body["start_time"],
+                    request_body["end_time"],
+                    request_body["freq"],
+                    request_body.get("future", False),
+                )
+            if (
+                task_type == "instrument"
+                and C.instrument_fast_path
+                and self.instrument_index.support(request_body["instruments"])
+            ):
+                return self.instrument_index.list_instruments(
+                    request_body["instruments"],
+                    request_body["start_time"],
+                    request_body["end_time"],
+                    request_body["freq"],
+                    request_body["as_list"],
+                )
+        except Exception as e:
+            self.logger.warning("The indexes can't answer the %s request: %.200s" % (task_type, e))
+        return None
+
+    def estimate_cost(self, task_type, request_body):
+        """Estimate the cost of a task as the number of instruments * fields * days it computes.
+
+        The markets are resolved to their sizes with the instrument index.
+        """
+        if task_type == "calendar":
+            return 1
+        freq = request_body["freq"]
+        instruments = request_body["instruments"]
+        try:
+            if isinstance(instruments, dict) and "market" in instruments:
+                n_instruments = self.instrument_index.size(instruments["market"], freq)
+            else:
+                n_instruments = len(instruments)
+            if task_type in ["feature", "feature_stream"] and int(request_body.get("disk_cache", 1)):
+                # the dataset cache is generated in the whole calendar
+                si, ei = self.calendar_index.locate(None, None, freq)
+            else:
+                si, ei = self.calendar_index.locate(request_body["start_time"], request_body["end_time"], freq)
+        except Exception as e:
+            self.logger.warning("Failed to estimate the cost of the %s task: %.200s" % (task_type, e))
+            return 0
+        n_days = max(ei - si, 1)
+        if task_type == "instrument":
+            # only the filters compute with the feature data
+            filter_pipe = instruments.get("filter_pipe", []) if isinstance(instruments, dict) else []
+            return n_instruments * n_days * len(filter_pipe)
+        return n_instruments * len(request_body["fields"]) * n_days
+
+    def route(self, task_type, request_body):
+        """Get the lane of a task by its estimated cost."""
+        if self.estimate_cost(task_type, request_body) >= C.heavy_task_cost:
+            return "heavy"
+        return "light"
@@ -6,43 +6,110 @@ from __future__ import print_function
 
 import time
 import json
+import uuid
+import shutil
 import threading
 import multiprocessing
+import multiprocessing.connection
 
 from .config import C
-from .utils import init_rabbitmq_channel, add_to_task_l_and_check_qlen, pop_ssids_from_redis
-
+from .codec import encode, decode, encode_message
+from .rabbitmq import get_channel, CONNECTION_ERRORS
+from .utils import (
+    init_rabbitmq_channel,
+    add_to_task_l_and_acquire,
+    pop_ssids_from_redis,
+    take_over_task,
+    new_lease_token,
+    TaskLease,
+    get_data_version,
+    get_process_rss,
+    get_task_queues,
+    get_shard_queue,
+    get_redis_connection,
+    get_task_uri,
+    group_ssids_by_reply_queue,
+    get_node_queue,
+    get_processor_node_id,
+    get_routed_task_queues,
+    set_result_memo,
+    incr_metric,
+)
+from .hash_ring import ProcessorMembership
+from .cache_index import get_cache_index
+from .dataset_cache import (
+    get_dataset_cache_uri,
+    get_dataset_cache_path,
+    get_dataset_lock_name,
+    is_dataset_cache_fresh,
+    write_dataset_cache,
+    slice_dataset_cache,
+)
+from .coalescing import (
+    register_inflight,
+    unregister_inflight,
+    find_inflight_superset,
+    park_task,
+    pop_parked_tasks,
+    register_superset_cache,
+    find_superset_cache,
+)
+
+import pandas as pd
 from qlib.data import D
-from qlib.data.cache import CacheUtils
+from qlib.data.data import DatasetD
+from qlib.data.cache import CacheUtils, DiskDatasetCache, H
 from qlib.log import get_module_logger
 
 
+class TaskParked(Exception):
+    """The task is parked until a feature task including all its features is finished."""
+
+
 class DataProcessor(threading.Thread):
+    """Data processor class.
+
+    The data processor forks long-lived worker processes for each task queue(`C.lane_max_process` for
+    each lane, or `C.max_process` if `C.task_routing` is disabled). They consume tasks from rabbitmq
+    and process them in-process, so the qlib memory cache and the rabbitmq channels are kept warm
+    across tasks.
+    A worker is recycled after `C.worker_max_tasks` tasks or when its RSS exceeds
+    `C.worker_max_rss` MB.
+    If `C.processor_routing` is enabled, the workers consume the queues of this node in the hash ring
+    of the data processor nodes too.
+    """
+
     def __init__(self):
         super(DataProcessor, self).__init__()
         self.logger = get_module_logger(self.__class__.__name__)
+        self._task_count = 0
+        self._data_version = None
+        # (queue, body) of the task being processed by the worker
+        self._current_task = None
 
     # Because the rabbitmq channel is not threading-safe.
     # We have to split the channels into different channel.
     @staticmethod
-    def get_task_channel(prefetch_count=1):
+    def get_task_channel(task_queue, prefetch_count=1):
         _task_channel = init_rabbitmq_channel(C.queue_host, C.queue_user, C.queue_pwd)
-        _task_channel.queue_declare(queue=C.task_queue, durable=True)
-        _task_channel.basic_qos(prefetch_count=prefetch_count)
+        _task_channel.queue_declare(queue=task_queue, durable=True)
+        # the prefetch count is shared by all the consumers of the channel
+        _task_channel.basic_qos(prefetch_count=prefetch_count, global_qos=True)
 
         return _task_channel
 
     @property
     def msg_channel(self):
-        # The initialization of the msg_channel is postponed after the child processes are initialized
-        # So the channels will not be shared between different processes.
-        if not hasattr(self, "_msg_channel"):
-            self._msg_channel = init_rabbitmq_channel(C.queue_host, C.queue_user, C.queue_pwd)
-            self._msg_channel.queue_declare(queue=C.message_queue, durable=True)
-            self._msg_channel.basic_qos(prefetch_count=C.max_concurrency)
-        return self._msg_channel
-
-    def publish_message(self, message_type, message_body, status_code, task_uri, detailed_info=None):
+        # The channels are pooled per process, so they will not be shared between different processes.
+        # A worker processes one task at a time, so the channel is not used by different threads at the same time.
+        return get_channel("message", queues=[C.message_queue])
+
+    @property
+    def parked_channel(self):
+        # the parked tasks are republished to the queues they were received from
+        return get_channel("parked")
+
+    def publish_message(self, message_type, message_body, status_code, task_uri, detailed_info=None, ssids=None):
         """Publish a message to rabbitmq message_queue.
 
         The message is published in the format as below:
@@ -82,67 +149,219 @@ class DataProcessor(threading.Thread):
                 'detailed_info': None
             }
 
-        The data processor could send some detailed_info to the client
+        The data processor could send some detailed_info to the client.
+        The data is encoded as json separately from the other fields, so it is relayed to the clients as is.
+        The message is emitted to the clients popped from the task list, who leave the room `task_uri` then.
+        The message is published to the reply queue of each request handler node with waiting clients.
+        The clients waiting for the task are popped from redis unless `ssids` is given.
         """
-        ssids = pop_ssids_from_redis(task_uri)
+        if ssids is None:
+            ssids = pop_ssids_from_redis(task_uri)
+        replies = group_ssids_by_reply_queue(ssids)
+        if not replies:
+            self.logger.warning("No client is waiting for the %s message of task %s" % (message_type, task_uri))
+            return
 
         self.logger.info("Publish %s message [%s] to rabbitmq" % (message_type, str(message_body)[:200]))
-        self.msg_channel.basic_publish(
-            exchange="",
-            routing_key=C.message_queue,
-            body=json.dumps(
-                dict(
-                    {
-                        "type": message_type,
-                        "data": message_body,
-                        "ssids": ssids,
-                        "status": status_code,
-                        "detailed_info": detailed_info,
-                    }
+        # the clients waiting for the task may connect to different request handler nodes
+        self.msg_channel.publish_batch(
+            [
+                (
+                    reply_queue,
+                    encode_message(
+                        {
+                            "type": message_type,
+                            "ssids": ssids,
+                            "room": task_uri,
+                            "status": status_code,
+                            "detailed_info": detailed_info,
+                        },
+                        message_body,
+                    ),
                 )
-            ),
+                for reply_queue, ssids in replies.items()
+            ]
         )
 
     @staticmethod
     def clear_task(body):
         """Callback function when initialize rabbitmq."""
-        tbody = json.loads(body.decode("utf-8"))
+        tbody = decode(body)
         ttype = tbody["meta"]["type"]
-        task_uri = D._uri(ttype, **(tbody["args"]))
+        if ttype == "feature_shard":
+            # the feature task of the shard is cleared
+            return
+        task_uri = DataProcessor.get_task_uri(tbody)
         # delete task
         pop_ssids_from_redis(task_uri)
 
+    @staticmethod
+    def get_task_uri(tbody):
+        # the canonical uri is computed once by the listener, the tasks of the older listeners don't carry it
+        return tbody["meta"].get("task_uri") or get_task_uri(tbody["meta"]["type"], tbody["args"])
+
+    def refresh_memory_cache(self):
+        """Clear the qlib memory cache of the worker if the data has been updated since it was filled."""
+        data_version = get_data_version()
+        if data_version != self._data_version:
+            self.logger.info("data version changes to %s, clear the memory cache" % data_version)
+            H.clear()
+            self._data_version = data_version
+
+    def memo_result(self, task_uri, result):
+        """Memo the result of a completed task, so the identical requests are answered by the listener."""
+        if not C.result_memo_ttl:
+            return
+        try:
+            # the data version when the task is started
+            set_result_memo(task_uri, self._data_version, result)
+        except Exception as e:
+            self.logger.warning("Failed to memo the result of task %s: %s" % (task_uri, e))
+
+    def should_recycle(self):
+        """Whether the worker has processed enough tasks or used too much memory and should exit."""
+        if C.worker_max_tasks and self._task_count >= C.worker_max_tasks:
+            self.logger.info("worker has processed %d tasks, recycle it" % self._task_count)
+            return True
+        if C.worker_max_rss:
+            rss = get_process_rss()
+            if rss > C.worker_max_rss * 1024 * 1024:
+                self.logger.info("worker RSS %.1fMB exceeds the limit, recycle it" % (rss / 1024 / 1024))
+                return True
+        return False
+
+    @staticmethod
+    def run_with_heartbeats(connection, target, *args):
+        """Run `target` in a thread and keep the consuming connection responding to heartbeats meanwhile.
+
+        Otherwise the broker will close the connection while a long task is processed.
+        """
+        t = threading.Thread(target=target, args=args)
+        t.start()
+        while True:
+            t.join(timeout=C.queue_heartbeat / 4 if C.queue_heartbeat else None)
+            if not t.is_alive():
+                break
+            connection.process_data_events(time_limit=0)
+
     def task_callback(self, ch, method, properties, body):
         """Callback function when a published task is received.
 
-        When a published task is received from rabbitmq,
-        a new process will be established to attend to the task.
+        When a published task is received from rabbitmq, it is processed in the worker process.
         `self.channel.basic_qos(prefetch_count=1)` is used to control the maximum concurrency of data processing process.
         """
         self.logger.debug("Receive task from queue at %f" % time.time())
-        tbody = json.loads(body.decode("utf-8"))
+        tbody = decode(body)
         ttype = tbody["meta"]["type"]
-        ssid = tbody["meta"]["ssid"]
         self.logger.info("receive %s task : '%.200s'" % (ttype, tbody))
+        if ttype == "feature_shard":
+            # the shards are deduplicated with their feature task
+            self.refresh_memory_cache()
+            self.run_with_heartbeats(ch.connection, self.feature_shard_callback, tbody)
+            self._task_count += 1
+        elif self.respond_from_cache(tbody):
+            self.logger.debug("respond %s task from the dataset cache at %f" % (ttype, time.time()))
+        else:
+            self.process_task(ch, method, tbody)
+
+        ch.basic_ack(delivery_tag=method.delivery_tag)
+        if self.should_recycle():
+            ch.stop_consuming()
 
-        task_uri = D._uri(ttype, **(tbody["args"]))
+    @staticmethod
+    def get_client_entry(tbody):
+        """Get the entry of the client waiting for the task."""
+        ssid = tbody["meta"]["ssid"]
+        # the message to the client should be published to the reply queue of its request handler node
+        reply_queue = tbody["meta"].get("reply_queue")
+        return "%s|%s" % (reply_queue, ssid) if reply_queue else ssid
+
+    def respond_from_cache(self, tbody):
+        """Publish the uri of the dataset cache of a feature task directly if it is up to date.
+
+        Most of the feature tasks are repeated ones, whose dataset caches have been generated and updated.
+        They are answered with a lookup of the cache index(or the meta file), without the deduplication,
+        the lease and the task thread.
+
+        :return: whether the task is answered
+        """
+        ttype = tbody["meta"]["type"]
+        if not C.feature_cache_fast_path or ttype not in ["feature", "feature_stream"]:
+            return False
+        obj = tbody["args"]
+        disk_cache = int(obj.get("disk_cache", 1))
+        if ttype == "feature_stream":
+            # the features are streamed from the dataset cache
+            obj = dict(obj, disk_cache=disk_cache or 1)
+        elif disk_cache != 1:
+            return False
+        freq = obj["freq"]
+        cache_uri = get_dataset_cache_uri(obj["instruments"], obj["fields"], freq)
+        cache_path = get_dataset_cache_path(cache_uri, freq)
+        # the calendar of the memory cache should be the latest one
+        self.refresh_memory_cache()
+        if not is_dataset_cache_fresh(cache_path, freq):
+            return False
+        with CacheUtils.reader_lock(get_redis_connection(), get_dataset_lock_name(cache_uri, freq)):
+            if not DiskDatasetCache.check_cache_exists(cache_path):
+                return False
+            # the meta file is shared by the evictors of all the hosts, the local index only by this host
+            CacheUtils.visit(cache_path)
+        self.index_dataset_cache(cache_uri, freq, access=True)
+        message_body = cache_uri if ttype == "feature" else self.get_stream_message(obj, cache_uri)
+        self.publish_message(ttype, message_body, 0, self.get_task_uri(tbody), ssids=[self.get_client_entry(tbody)])
+        incr_metric("feature_cache_hit")
+        return True
+
+    def process_task(self, ch, method, tbody):
+        """Process the task if no identical task is being processed."""
+        ttype = tbody["meta"]["type"]
+        ssid = tbody["meta"]["ssid"]
+        task_uri = self.get_task_uri(tbody)
         self.logger.debug("check task  at %f" % time.time())
-        qlen = add_to_task_l_and_check_qlen(task_uri, ssid)
-        if qlen == 1:  # first to create the task queue
-            # no task is running
-            # here the data processes will not use the historical memory cache as before
-            # acutally the memory cache is used for accelerate the inside of a
-            # process
+        token = new_lease_token()
+        entry = self.get_client_entry(tbody)
+        acquired = add_to_task_l_and_acquire(task_uri, entry, token, tbody["meta"].get("raw_uri", ""))
+        if not acquired and method.redelivered:
+            acquired = self.wait_for_lease(ch.connection, task_uri, token)
+        if acquired:  # first to create the task queue or the lease of the task has expired
+            if acquired == 2:
+                self.logger.warning(f"The lease of task {task_uri} has expired. Take over the task.")
 
             self.logger.debug("start processing data at %f" % time.time())
-            # In order to no longer clear the MemoryCache, a process has been created here.
-            p = multiprocessing.Process(target=getattr(self, "%s_callback" % ttype), args=(tbody["args"], task_uri))
-            p.start()
-            p.join()
+            # The MemoryCache is kept across tasks and only cleared when the data is updated.
+            self.refresh_memory_cache()
+            self._current_task = (method.routing_key, tbody)
+            try:
+                with TaskLease(task_uri, token):
+                    self.run_with_heartbeats(
+                        ch.connection, getattr(self, "%s_callback" % ttype), tbody["args"], task_uri
+                    )
+            finally:
+                self._current_task = None
+            self._task_count += 1
         else:
             self.logger.debug(f"There has already been the same task. Just append the ssid {ssid}.")
 
-        ch.basic_ack(delivery_tag=method.delivery_tag)
+    @staticmethod
+    def wait_for_lease(connection, task_uri, token):
+        """Wait for the lease of a redelivered task to expire and take over the task.
+
+        A task is redelivered if the worker processing it died before acknowledging it, then the lease held
+        by that worker expires in `C.task_lease_ttl` seconds and nobody else would take over the task.
+        If the lease is still renewed after that, the task is being processed by a living worker, which
+        answers the client of the redelivered task too.
+
+        :return: 2 if the task is taken over, 0 otherwise
+        """
+        deadline = time.time() + C.task_lease_ttl * 2
+        while time.time() < deadline:
+            taken = take_over_task(task_uri, token)
+            if taken:
+                return 2 if taken == 2 else 0
+            # keep responding to the heartbeats while waiting
+            connection.sleep(1)
+        return 0
 
     def calendar_callback(self, cbody, task_uri):
         """Target function for the established process when the received task asks for calendar data.
@@ -164,6 +383,7 @@ class DataProcessor(threading.Thread):
             calendar_result = D.calendar(start_time, end_time, freq, future)
             calendar_result = [str(c) for c in calendar_result]
             self.logger.debug("finish processing calendar data and publish message at %f" % time.time())
+            self.memo_result(task_uri, calendar_result)
             self.publish_message("calendar", calendar_result, status_code, task_uri)
         except Exception as e:
             self.logger.exception(f"Error while processing request %.200s" % e)
@@ -192,19 +412,34 @@ class DataProcessor(threading.Thread):
             if isinstance(instrument_result, dict):
                 instrument_result = {i: [(str(s), str(e)) for s, e in t] for i, t in instrument_result.items()}
             self.logger.debug("finish processing instrument data and publish message at %f" % time.time())
+            self.memo_result(task_uri, instrument_result)
             self.publish_message("instrument", instrument_result, status_code, task_uri)
         except Exception as e:
             self.logger.exception(f"Error while processing request %.200s" % e)
             self.publish_message("instrument", None, 1, task_uri, str(e))
 
-    def feature_callback(self, obj, task_uri):
-        """Target function for the established process when the received task asks for feature data.
-
-        Call the data provider to acquire data and publish the feature uri.
-
-        .. note:: it only publish the cached file uri instead of the real dataset.
-        """
+    def get_features_uri(self, obj, task_uri):
+        """Generate the dataset cache of a feature task and get its uri."""
+        uri = self.find_or_generate_features_uri(obj, task_uri)
+        if uri:
+            self.index_dataset_cache(uri, obj["freq"])
+        return uri
+
+    def index_dataset_cache(self, cache_uri, freq, access=False):
+        """Record the dataset cache written or accessed in the cache index."""
+        cache_index = get_cache_index()
+        if cache_index is None:
+            return
+        try:
+            cache_path = get_dataset_cache_path(cache_uri, freq)
+            if access:
+                cache_index.record_access("dataset", freq, cache_path)
+            else:
+                cache_index.update_entry("dataset", freq, cache_path)
+        except Exception as e:
+            self.logger.warning("Failed to index the dataset cache %s: %s" % (cache_uri, e))
 
+    def find_or_generate_features_uri(self, obj, task_uri):
         instruments = obj["instruments"]
         fields = obj["fields"]
         start_time = obj["start_time"]
@@ -216,42 +451,297 @@ class DataProcessor(threading.Thread):
             end_time = None
         freq = obj["freq"]
 
-        status_code = 0
-        self.logger.debug("process feature data at %f" % time.time())
-
         if not hasattr(D, "features_uri"):
             msg = "Your dataset cache mechanism doesn't have `_dataset_uri` method."
             self.logger.error(msg)
             raise AttributeError(msg)
+        if not C.coalesce_features or disk_cache != 1:
+            return self.generate_features_uri(instruments, fields, start_time, end_time, freq, disk_cache)
+
+        cache_uri = get_dataset_cache_uri(instruments, fields, freq, disk_cache)
+        if not DiskDatasetCache.check_cache_exists(get_dataset_cache_path(cache_uri, freq)):
+            uri = self.features_uri_from_superset(cache_uri, instruments, fields, freq, task_uri)
+            if uri is not None:
+                return uri
+        # the overlapping feature tasks coming later are parked until this task is finished
+        register_inflight(cache_uri, task_uri, instruments, fields, freq)
         try:
-            uri = D.features_uri(
-                instruments=instruments,
-                fields=fields,
-                start_time=start_time,
-                end_time=end_time,
-                freq=freq,
-                disk_cache=disk_cache,
-            )
+            uri = self.generate_features_uri(instruments, fields, start_time, end_time, freq, disk_cache)
+            # the feature tasks coming later may be sliced from this dataset cache
+            register_superset_cache(uri, instruments, fields, freq)
+            return uri
+        finally:
+            unregister_inflight(cache_uri)
+            self.republish_parked_tasks(task_uri)
+
+    def park_task(self, task_uri, superset_uri, superset_task_uri):
+        """Park the task being processed until the feature task `superset_task_uri` is finished.
+
+        The clients waiting for the task are popped with it, and the task is republished for each of them
+        when `superset_task_uri` is finished, then it's answered from the dataset cache `superset_uri`.
+
+        :raise TaskParked: always
+        """
+        task_queue, tbody = self._current_task
+        record = {
+            "queue": task_queue,
+            "type": tbody["meta"]["type"],
+            "task_uri": task_uri,
+            "args": tbody["args"],
+            "entries": pop_ssids_from_redis(task_uri),
+        }
+        if not park_task(superset_uri, superset_task_uri, record):
+            # the task has been finished before the record is parked
+            self.republish_parked_tasks(superset_task_uri)
+        incr_metric("feature_parked")
+        raise TaskParked(superset_task_uri)
+
+    def republish_parked_tasks(self, task_uri):
+        """Republish the tasks parked on the task `task_uri`, one for each client waiting for them."""
+        for record in pop_parked_tasks(task_uri):
+            messages = []
+            for entry in record["entries"]:
+                reply_queue, _, ssid = entry.rpartition("|")
+                meta = {"type": record["type"], "ssid": ssid, "task_uri": record["task_uri"]}
+                meta["reply_queue"] = reply_queue or None
+                messages.append((record["queue"], encode({"meta": meta, "args": record["args"]})))
+            try:
+                self.parked_channel.publish_batch(messages)
+            except Exception as e:
+                self.logger.error("Failed to republish the parked task %s: %r" % (record["task_uri"], e))
+                self.publish_message(
+                    record["type"], None, 1, record["task_uri"], "Failed to process the task", record["entries"]
+                )
+
+    def generate_features_uri(self, instruments, fields, start_time, end_time, freq, disk_cache):
+        instruments_d = self.get_instruments_to_shard(instruments, fields, freq, disk_cache)
+        if instruments_d is not None:
+            return self.features_uri_in_shards(instruments, instruments_d, fields, freq, disk_cache)
+        return D.features_uri(
+            instruments=instruments,
+            fields=fields,
+            start_time=start_time,
+            end_time=end_time,
+            freq=freq,
+            disk_cache=disk_cache,
+        )
+
+    def features_uri_from_superset(self, cache_uri, instruments, fields, freq, task_uri):
+        """Get the features from a dataset cache which includes all of them.
+
+        If the dataset cache is being generated by a feature task, the task is parked until that task is
+        finished(`park_task`), so the worker is not blocked meanwhile. Otherwise if such a dataset cache has
+        been generated,
+
+            - if it has the same instruments, the client can read the features from it directly,
+              its uri is returned
+            - otherwise the dataset cache of the request is sliced from it by instruments
+
+        :raise TaskParked: if the task is parked
+        :return: the uri of the dataset cache, None if there is no such dataset cache
+        """
+        superset = find_inflight_superset(cache_uri, instruments, fields, freq)
+        if superset is not None and self._current_task is not None:
+            superset_uri, superset_task_uri, _ = superset
+            self.park_task(task_uri, superset_uri, superset_task_uri)
+        superset = find_superset_cache(cache_uri, instruments, fields, freq)
+        if superset is None:
+            return None
+        superset_uri, coverage = superset
+
+        superset_path = get_dataset_cache_path(superset_uri, freq)
+        redis_t = get_redis_connection()
+        with CacheUtils.reader_lock(redis_t, get_dataset_lock_name(superset_uri, freq)):
+            if not DiskDatasetCache.check_cache_exists(superset_path):
+                # the task failed or the dataset cache has been removed
+                return None
+            if coverage == "same":
+                incr_metric("feature_coalesced")
+                return superset_uri
+            self.logger.debug("slice the dataset cache from %s at %f" % (superset_uri, time.time()))
+            with CacheUtils.writer_lock(redis_t, get_dataset_lock_name(cache_uri, freq)):
+                slice_dataset_cache(superset_path, get_dataset_cache_path(cache_uri, freq), instruments, fields, freq)
+        incr_metric("feature_coalesced")
+        return cache_uri
+
+    def feature_callback(self, obj, task_uri):
+        """Target function for the established process when the received task asks for feature data.
+
+        Call the data provider to acquire data and publish the feature uri.
+
+        .. note:: it only publish the cached file uri instead of the real dataset.
+        """
+        status_code = 0
+        self.logger.debug("process feature data at %f" % time.time())
+        try:
+            uri = self.get_features_uri(obj, task_uri)
             self.logger.debug("finish processing feature data and publish message at %f" % time.time())
             self.publish_message("feature", uri, status_code, task_uri)
+        except TaskParked as e:
+            self.logger.info("park the feature task until the task %s is finished" % e)
         except Exception as e:
             self.logger.exception(f"Error while processing request %.200s" % e)
             self.publish_message("feature", None, 1, task_uri, str(e))
 
-    def start_consuming(self):
-        """Start consuming"""
-        _task_channel = self.get_task_channel(prefetch_count=1)
-        _task_channel.basic_consume(on_message_callback=self.task_callback, queue=C.task_queue)
+    def feature_stream_callback(self, obj, task_uri):
+        """Target function for the established process when the received task asks for streamed feature data.
+
+        Call the data provider to acquire data and publish the feature uri with the request, so the
+        responder can stream the requested features in the dataset cache to the clients.
+        """
+        # the features are streamed from the dataset cache
+        obj = dict(obj, disk_cache=int(obj.get("disk_cache", 1)) or 1)
+        self.logger.debug("process feature stream data at %f" % time.time())
+        try:
+            uri = self.get_features_uri(obj, task_uri)
+            self.publish_message("feature_stream", self.get_stream_message(obj, uri), 0, task_uri)
+        except TaskParked as e:
+            self.logger.info("park the feature stream task until the task %s is finished" % e)
+        except Exception as e:
+            self.logger.exception(f"Error while processing request %.200s" % e)
+            self.publish_message("feature_stream", None, 1, task_uri, str(e))
+
+    @staticmethod
+    def get_stream_message(obj, uri):
+        """Get the message of a feature stream task, the responder streams the features in the dataset cache."""
+        return {
+            "uri": uri,
+            "freq": obj["freq"],
+            "fields": obj["fields"],
+            "start_time": obj["start_time"],
+            "end_time": obj["end_time"],
+        }
+
+    @staticmethod
+    def get_instruments_to_shard(instruments, fields, freq, disk_cache):
+        """Get the instruments of a feature task if its dataset cache should be generated in shards.
+
+        :return: list of instruments or dict of instruments and their spans, None if it should not be sharded
+        """
+        if not C.feature_shard_size or not disk_cache:
+            return None
+        if disk_cache == 1:
+            cache_uri = get_dataset_cache_uri(instruments, fields, freq, disk_cache)
+            if DiskDatasetCache.check_cache_exists(get_dataset_cache_path(cache_uri, freq)):
+                return None
+        instruments_d = DatasetD.get_instruments_d(instruments, freq)
+        if len(instruments_d) <= C.feature_shard_size:
+            return None
+        return instruments_d
+
+    @property
+    def shard_channel(self):
+        return get_channel("shard", queues=[get_shard_queue()])
+
+    def features_uri_in_shards(self, instruments, instruments_d, fields, freq, disk_cache):
+        """Generate the dataset cache of a feature task in shards.
+
+        The instruments are split into shards of `C.feature_shard_size` instruments, which are published to
+        the shard queue and processed by the shard workers in parallel. The features of the shards are merged
+        into the dataset cache after all of them are finished.
+
+        :return: the uri of the dataset cache
+        """
+        cache_uri = get_dataset_cache_uri(instruments, fields, freq, disk_cache)
+        cache_path = get_dataset_cache_path(cache_uri, freq)
+        shard_dir = cache_path.with_suffix(".shards")
+        # the shard workers report their results to this list
+        result_key = "%s:shards:%s" % (cache_uri, uuid.uuid4().hex)
+        redis_t = get_redis_connection()
+        with CacheUtils.writer_lock(redis_t, get_dataset_lock_name(cache_uri, freq)):
+            try:
+                shard_dir.mkdir(parents=True, exist_ok=True)
+                names = list(instruments_d)
+                messages = []
+                for i in range(0, len(names), C.feature_shard_size):
+                    shard = names[i : i + C.feature_shard_size]
+                    if isinstance(instruments_d, dict):
+                        shard = {inst: [(str(s), str(e)) for s, e in instruments_d[inst]] for inst in shard}
+                    shard_body = {
+                        "meta": {"type": "feature_shard", "result_key": result_key},
+                        "args": {"instruments": shard, "fields": fields, "freq": freq, "path": str(shard_dir / str(i))},
+                    }
+                    messages.append((get_shard_queue(), encode(shard_body)))
+                self.logger.info("split the feature task into %d shards" % len(messages))
+                self.shard_channel.publish_batch(messages)
+
+                shard_paths = []
+                deadline = time.time() + C.feature_shard_timeout
+                while len(shard_paths) < len(messages):
+                    if time.time() > deadline:
+                        raise TimeoutError("Timeout while waiting for the shards of the feature task")
+                    item = redis_t.blpop(result_key, timeout=1)
+                    if item is None:
+                        continue
+                    result = json.loads(item[1].decode("utf-8"))
+                    if result["status"] != 0:
+                        raise ValueError("Error while processing the shard: %s" % result["detailed_info"])
+                    shard_paths.append(result["path"])
+
+                self.logger.debug("merge the shards into dataset cache at %f" % time.time())
+                features = pd.concat([pd.read_pickle(path) for path in shard_paths])
+                write_dataset_cache(cache_path, features, instruments, freq)
+            finally:
+                redis_t.delete(result_key)
+                shutil.rmtree(shard_dir, ignore_errors=True)
+        return cache_uri
+
+    def feature_shard_callback(self, tbody):
+        """Target function for the worker when the received task is a shard of a feature task.
+
+        Calculate the features of the instruments in the shard in the whole calendar and
+        report the result to the feature task.
+        """
+        args = tbody["args"]
+        instruments = args["instruments"]
+        if isinstance(instruments, dict):
+            instruments = {i: [(pd.Timestamp(s), pd.Timestamp(e)) for s, e in t] for i, t in instruments.items()}
+        try:
+            _calendar = D.calendar(freq=args["freq"])
+            features = DatasetD.dataset(
+                instruments, args["fields"], _calendar[0], _calendar[-1], args["freq"], disk_cache=0
+            )
+            features.to_pickle(args["path"])
+            result = {"status": 0, "path": args["path"], "detailed_info": None}
+        except Exception as e:
+            self.logger.exception(f"Error while processing shard %.200s" % e)
+            result = {"status": 1, "path": args["path"], "detailed_info": str(e)}
+        # the feature task may have given up and deleted the list, so the list expires in any case
+        pipe = get_redis_connection().pipeline()
+        pipe.rpush(tbody["meta"]["result_key"], json.dumps(result))
+        pipe.expire(tbody["meta"]["result_key"], C.feature_shard_timeout)
+        pipe.execute()
+
+    def start_consuming(self, task_queue):
+        """Start consuming
+
+        Return when the worker should be recycled or the connection is lost.
+        """
+        _task_channel = self.get_task_channel(task_queue, prefetch_count=1)
+        _task_channel.basic_consume(on_message_callback=self.task_callback, queue=task_queue)
+        if C.processor_routing and task_queue in get_routed_task_queues():
+            # the tasks routed to this node
+            node_queue = get_node_queue(task_queue, get_processor_node_id())
+            _task_channel.queue_declare(queue=node_queue, durable=True)
+            _task_channel.basic_consume(on_message_callback=self.task_callback, queue=node_queue)
         try:
             _task_channel.start_consuming()
         except KeyboardInterrupt:
-            _task_channel.close()
-
-    def run(self):
-        """Start the process that consumes tasks and process data."""
-        CacheUtils.reset_lock()
-        task_channel = self.get_task_channel(C.max_concurrency)
-        for method, properties, body in task_channel.consume(C.task_queue, inactivity_timeout=C.inactivity_timeout):
+            pass
+        except CONNECTION_ERRORS as e:
+            self.logger.warning("rabbitmq connection is lost(%r), restart the worker" % e)
+            return
+        _task_channel.connection.close()
+
+    def start_worker(self, task_queue):
+        p = multiprocessing.Process(target=self.start_consuming, args=(task_queue,))
+        p.start()
+        return p
+
+    def clear_task_queue(self, task_queue):
+        """Clear the remaining tasks in `task_queue`."""
+        task_channel = self.get_task_channel(task_queue, C.max_concurrency)
+        for method, properties, body in task_channel.consume(task_queue, inactivity_timeout=C.inactivity_timeout):
             # if server crashes with some remaining tasks, when the server restarts this process
             # will clear the remaining tasks.
             # with inactivity_timeout, if no remaining messages exist the consume() function will
@@ -265,14 +755,38 @@ class DataProcessor(threading.Thread):
                 break
         task_channel.cancel()
 
-        self.logger.info("data processor module start...")
-
-        p_list = []
-        for i in range(C.max_process):
-            p_list.append(multiprocessing.Process(target=self.start_consuming, args=()))
+    def run(self):
+        """Start the process that consumes tasks and process data."""
+        CacheUtils.reset_lock()
+        task_queues = get_task_queues()
+        membership = None
+        if C.processor_routing:
+            node = get_processor_node_id()
+            # the tasks left in the queues of this node are cleared too
+            for task_queue in get_routed_task_queues():
+                self.clear_task_queue(get_node_queue(task_queue, node))
+            membership = ProcessorMembership(node, get_routed_task_queues())
+        for task_queue in task_queues:
+            self.clear_task_queue(task_queue)
 
-        for p in p_list:
-            p.start()
+        self.logger.info("data processor module start...")
 
-        for p in p_list:
-            p.join()
+        # each task queue is consumed by its own worker processes
+        p_list = [(q, self.start_worker(q)) for q, n in task_queues.items() for _ in range(n)]
+        if membership is not None:
+            # join the hash ring after the queues of this node are declared
+            membership.start()
+        try:
+            while True:
+                # replace the recycled or crashed workers
+                multiprocessing.connection.wait([p.sentinel for _, p in p_list])
+                for i, (q, p) in enumerate(p_list):
+                    if not p.is_alive():
+                        p.join()
+                        self.logger.info(
+                            "worker %d of %s exited with code %s, start a new one" % (p.pid, q, p.exitcode)
+                        )
+                        p_list[i] = (q, self.start_worker(q))
+        finally:
+            if membership is not None:
+                membership.leave()
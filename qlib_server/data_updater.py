@@ -4,14 +4,32 @@
 from __future__ import division
 from __future__ import print_function
 
+import re
 import time
+import pickle
 import schedule
+import redis_lock
 import traceback
 from tqdm import tqdm
 from pathlib import Path
 from qlib.log import get_module_logger
+from qlib.utils import remove_fields_space
+from qlib.config import C as QC
+from qlib.data.cache import CacheUtils
 from concurrent.futures import ProcessPoolExecutor, as_completed
 
+from .config import C
+from .utils import notify_data_updated, get_redis_connection
+from .dataset_cache import get_dataset_lock_name
+from .cache_evictor import CacheEvictor
+from .cache_index import get_cache_index, get_cache_dir
+from .watermark import SourceWatermark
+
+# the status returned by qlib when the cache has been updated to the latest calendar
+UP_TO_DATE = 1
+# the raw features(and the point-in-time ones), which are not cached by qlib
+RAW_FIELD_PATTERN = re.compile(r"\$\$?\w+")
+
 
 class UpdateCacheException(Exception):
     pass
@@ -22,12 +40,16 @@ class DataUpdater(object):
 
     The working procedure of this class is:
 
-        - scan cache directory
+        - evict the unused caches exceeding the quotas
+        - scan cache directory(or query the cache index if `C.cache_index_path` is set)
         - read every meta file
+        - skip the caches whose raw data has not changed since they were updated(`C.incremental_update`)
         - update cache files
     """
 
-    def __init__(self, is_interface=False, update_interval=24, max_workers=20, freq: str = "day"):
+    def __init__(
+        self, is_interface=False, update_interval=24, max_workers=20, freq: str = "day", dataset_max_workers=None
+    ):
         """
 
         Parameters
@@ -38,12 +60,15 @@ class DataUpdater(object):
             the hourly interval to update the cache
         max_workers: int
             multi-process count
+        dataset_max_workers: int
+            multi-process count of updating the dataset caches, `C.dataset_update_workers` by default
         """
         super(DataUpdater, self).__init__()
         self.logger = get_module_logger(self.__class__.__name__)
         self.is_interface = is_interface
         self.update_interval = update_interval
         self.max_workers = max_workers
+        self.dataset_max_workers = C.dataset_update_workers if dataset_max_workers is None else dataset_max_workers
         self.freq = freq
 
     @staticmethod
@@ -52,11 +77,14 @@ class DataUpdater(object):
 
         pre_m_time = Path(cache_file).stat().st_mtime
         # update cache
-        ExpressionD.update(cache_file.parent.name, cache_file.name)
+        res = ExpressionD.update(cache_file.parent.name, cache_file.name)
+        if res == UP_TO_DATE:
+            return res
         # check st_mtime
         cur_m_time = Path(cache_file).stat().st_mtime
         if cur_m_time <= pre_m_time:
             raise UpdateCacheException("Cache file is not updated, please check manually.")
+        return res
 
     def update_expression_cache(self):
         from qlib.data.data import ExpressionD
@@ -67,20 +95,34 @@ class DataUpdater(object):
             self.logger.error("No cache mechanism detected: \n{}\n".format(traceback.format_exc()))
             return
 
-        all_cache_path = Path(expression_cache_dir).glob("*/*")
-        return self._upate_workers(all_cache_path, self._update_expression_cache)
+        all_cache_path = self.get_cache_paths("expression")
+        if all_cache_path is None:
+            all_cache_path = Path(expression_cache_dir).glob("*/*")
+        return self._upate_workers(all_cache_path, self._update_expression_cache, "expression")
 
     @staticmethod
     def _update_dataset_cache(cache_file):
         from qlib.data.data import DatasetD
 
-        # data file
-        pre_m_time = Path(cache_file).stat().st_mtime
-        DatasetD.update(cache_file)
-        # check st_mtime
-        cur_m_time = Path(cache_file).stat().st_mtime
-        if cur_m_time <= pre_m_time:
-            raise UpdateCacheException("Cache file is not updated, please check manually.")
+        # the dataset caches are updated in parallel, and maybe by the updaters of other nodes
+        lock = redis_lock.Lock(
+            get_redis_connection(), "qlib_server:update-%s" % Path(cache_file).name, expire=60, auto_renewal=True
+        )
+        if not lock.acquire(blocking=False):
+            raise UpdateCacheException("Cache file is being updated by another updater.")
+        try:
+            # data file
+            pre_m_time = Path(cache_file).stat().st_mtime
+            res = DatasetD.update(cache_file)
+            if res == UP_TO_DATE:
+                return res
+            # check st_mtime
+            cur_m_time = Path(cache_file).stat().st_mtime
+            if cur_m_time <= pre_m_time:
+                raise UpdateCacheException("Cache file is not updated, please check manually.")
+            return res
+        finally:
+            lock.release()
 
     def update_dataset_cache(self):
         from qlib.data.data import DatasetD
@@ -91,37 +133,217 @@ class DataUpdater(object):
             self.logger.error("No cache mechanism detected: \n{}\n".format(traceback.format_exc()))
             return
 
-        all_cache_path = Path(dataset_cache_dir).iterdir()
-        return self._upate_workers(all_cache_path, self._update_dataset_cache)
+        all_cache_path = self.get_cache_paths("dataset")
+        if all_cache_path is None:
+            all_cache_path = Path(dataset_cache_dir).iterdir()
+        return self._upate_workers(all_cache_path, self._update_dataset_cache, "dataset")
+
+    def get_cache_paths(self, kind):
+        """Get the paths of the caches from the cache index, None if there is no cache index."""
+        cache_index = get_cache_index()
+        if cache_index is None:
+            return None
+        # index the caches written by the others since the last update
+        cache_index.sync(self.freq)
+        return [Path(e.path) for e in cache_index.entries(kind, self.freq)]
+
+    def evict_cache(self):
+        """Evict the least used caches exceeding the quotas and return the evicted ones."""
+        return CacheEvictor(freq=self.freq).evict()
 
-    def _upate_workers(self, all_cache_path, worker_fun):
+    def filter_changed_caches(self, kind, cache_path_list, cache_index):
+        """Split the caches by whether their raw data has changed since they were updated.
+
+        The unchanged caches are indexed as updated to the latest calendar. The meta files of the unchanged
+        dataset caches are advanced to the latest calendar too, so the processors of all the nodes find them
+        up to date. The expression caches are appended by their positions in the calendar, so their meta files
+        are left alone, and the updaters without their watermarks update them with qlib.
+
+        :return: (the changed caches, the unchanged caches, the watermarks of the caches)
+        """
+        from qlib.data import D
+
+        latest = str(D.calendar(freq=self.freq)[-1])
+        source_watermark = SourceWatermark(self.freq)
+        changed, unchanged, watermarks = [], [], {}
+        for cache_path in cache_path_list:
+            key = cache_index.get_key(kind, cache_path)
+            entry = cache_index.get(kind, self.freq, key)
+            watermark = source_watermark.get(kind, cache_path)
+            watermarks[cache_path] = watermark
+            if watermark is not None and entry is not None and entry.watermark is not None:
+                if watermark <= entry.watermark:
+                    try:
+                        if kind == "dataset":
+                            self.advance_last_update(cache_path, latest)
+                    except Exception as e:
+                        self.logger.warning("Failed to advance the meta file of %s, update it: %s" % (cache_path, e))
+                    else:
+                        cache_index.set_watermark(kind, self.freq, key, watermark, last_update=latest)
+                        unchanged.append(cache_path)
+                        continue
+            changed.append(cache_path)
+        return changed, unchanged, watermarks
+
+    def advance_last_update(self, cache_path, latest):
+        """Set the last update in the meta file of a dataset cache to `latest` under its writer lock."""
+        cache_path = Path(cache_path)
+        meta_path = cache_path.with_suffix(".meta")
+        with CacheUtils.writer_lock(get_redis_connection(), get_dataset_lock_name(cache_path.name, self.freq)):
+            with meta_path.open("rb") as f:
+                meta = pickle.load(f)
+            if meta["info"].get("last_update") == latest:
+                return
+            meta["info"]["last_update"] = latest
+            tmp_path = meta_path.with_suffix(".meta.tmp")
+            with tmp_path.open("wb") as f:
+                pickle.dump(meta, f, protocol=QC.dump_protocol_version)
+            tmp_path.replace(meta_path)
+
+    def get_expression_keys(self, cache_path, source_watermark, will_generate):
+        """Get the (instrument, field) of the expression caches generated to update a dataset cache.
+
+        The dataset caches generating the same expression caches at the same time conflict on their writer
+        locks. The raw features are not cached by qlib and the existing expression caches are only read,
+        so they are not shared by the dataset caches.
+
+        :param will_generate: function(instrument, field) whether the expression cache will be generated
+        """
+        with Path(cache_path).with_suffix(".meta").open("rb") as f:
+            info = pickle.load(f)["info"]
+        instruments = info["instruments"]
+        if isinstance(instruments, dict) and "market" in instruments:
+            instruments = source_watermark.get_market_instruments(instruments["market"])
+        fields = [field for field in remove_fields_space(info["fields"]) if not RAW_FIELD_PATTERN.fullmatch(field)]
+        return {(inst.lower(), field) for inst in instruments for field in fields if will_generate(inst.lower(), field)}
+
+    def get_generated_expressions(self):
+        """Get the function(instrument, field) whether the expression cache is missing and will be generated."""
+        from qlib.data.data import ExpressionD
+
+        cache_dir = get_cache_dir("expression", self.freq)
+        if cache_dir is None:
+            # no expression cache mechanism
+            return lambda instrument, field: False
+        cache_index = get_cache_index()
+        indexed = None if cache_index is None else {e.key for e in cache_index.entries("expression", self.freq)}
+        missing = {}
+
+        def will_generate(instrument, field):
+            if (instrument, field) not in missing:
+                key = f"{instrument}/{ExpressionD._uri(instrument, field, None, None, self.freq)}"
+                exists = key in indexed if indexed is not None else cache_dir.joinpath(key).exists()
+                missing[(instrument, field)] = not exists
+            return missing[(instrument, field)]
+
+        return will_generate
+
+    def group_dataset_caches(self, cache_path_list):
+        """Group the dataset caches generating the same expression caches, so each group is updated in one process.
+
+        The dataset caches are connected by the (instrument, field) of the expression caches they generate with
+        union-find, the groups are the connected components. Usually the expression caches have been generated
+        and updated before, so most of the dataset caches are updated in parallel.
+        """
+        source_watermark = SourceWatermark(self.freq)
+        will_generate = self.get_generated_expressions()
+        parent = list(range(len(cache_path_list)))
+
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        owners = {}
+        for i, cache_path in enumerate(cache_path_list):
+            try:
+                keys = self.get_expression_keys(cache_path, source_watermark, will_generate)
+            except Exception:
+                # the meta file is broken, the cache is removed by qlib when it is updated
+                continue
+            for key in keys:
+                j = owners.setdefault(key, i)
+                if j != i:
+                    parent[find(i)] = find(j)
+        groups = {}
+        for i, cache_path in enumerate(cache_path_list):
+            groups.setdefault(find(i), []).append(cache_path)
+        # the larger groups are started first
+        return sorted(groups.values(), key=len, reverse=True)
+
+    @staticmethod
+    def _update_group(worker_fun, cache_paths):
+        """Update the caches of a group one by one.
+
+        :return: [(cache_path, result, warning message, error traceback)]
+        """
+        results = []
+        for cache_path in cache_paths:
+            try:
+                results.append((cache_path, worker_fun(cache_path), None, None))
+            except UpdateCacheException as e:
+                results.append((cache_path, None, str(e), None))
+            except Exception:
+                results.append((cache_path, None, None, traceback.format_exc()))
+        return results
+
+    def _upate_workers(self, all_cache_path, worker_fun, kind=None):
         cache_path_list = list(filter(lambda path: "." not in path.name, all_cache_path))
         cache_length = len(cache_path_list)
         error_info = []
         warning_info = []
-        with tqdm(total=cache_length) as p_bar:
-            with ProcessPoolExecutor(
-                max_workers=1 if "dataset_cache" in worker_fun.__name__ else self.max_workers
-            ) as executor:
+        up_to_date = []
+        watermarks = {}
+        cache_index = None if kind is None else get_cache_index()
+        if cache_index is not None and C.incremental_update:
+            cache_path_list, up_to_date, watermarks = self.filter_changed_caches(kind, cache_path_list, cache_index)
+        if kind == "dataset":
+            groups = self.group_dataset_caches(cache_path_list)
+            max_workers = self.dataset_max_workers
+        else:
+            groups = [[cache_path] for cache_path in cache_path_list]
+            max_workers = self.max_workers
+        with tqdm(total=len(cache_path_list)) as p_bar:
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
                 futures_map = {}
-                for cache_path in cache_path_list:
-                    futures_map[executor.submit(worker_fun, cache_path)] = cache_path
+                for group in groups:
+                    futures_map[executor.submit(self._update_group, worker_fun, group)] = group
                 for future in as_completed(futures_map):
-                    cache_path = futures_map[future]
                     try:
-                        res = future.result()
-                    except UpdateCacheException as e:
-                        warning_info.append((cache_path, str(e)))
+                        results = future.result()
                     except Exception:
-                        error_info.append((cache_path, traceback.format_exc()))
-                    # update tqdm bar
-                    p_bar.update()
+                        # the worker process is broken
+                        results = [
+                            (cache_path, None, None, traceback.format_exc()) for cache_path in futures_map[future]
+                        ]
+                    for cache_path, res, warning, error in results:
+                        if warning is not None:
+                            warning_info.append((cache_path, warning))
+                        elif error is not None:
+                            error_info.append((cache_path, error))
+                        else:
+                            if res == UP_TO_DATE:
+                                up_to_date.append(cache_path)
+                            if cache_index is not None:
+                                self.index_updated_cache(cache_index, kind, cache_path, watermarks.get(cache_path))
+                        # update tqdm bar
+                        p_bar.update()
 
         for _path, _msg in warning_info:
             self.logger.debug(f"{worker_fun.__name__}: {_path}: {_msg}")
         for _path, _msg in error_info:
             self.logger.error(f"{worker_fun.__name__}: {_path}: {_msg}")
-        return cache_length, len(warning_info), len(error_info)
+        return cache_length, len(up_to_date), len(warning_info), len(error_info)
+
+    def index_updated_cache(self, cache_index, kind, cache_path, watermark):
+        try:
+            cache_index.update_entry(kind, self.freq, cache_path)
+            # the watermark of the raw data the cache is updated with
+            if watermark is not None:
+                cache_index.set_watermark(kind, self.freq, cache_index.get_key(kind, cache_path), watermark)
+        except Exception:
+            self.logger.warning(f"failed to index {cache_path}: {traceback.format_exc()}")
 
     def update(self, notify_func=None):
         """Update main function.
@@ -134,17 +356,23 @@ class DataUpdater(object):
 
         H.clear()
 
+        # the evicted caches are not updated
+        s_time = time.time()
+        self.logger.info("start evict_cache")
+        evicted = self.evict_cache()
+        self.logger.info(f"finish evict_cache, {len(evicted)} caches are evicted in {time.time() - s_time}")
+
         # update expression cache
         s_time = time.time()
         self.logger.info("start update_expression_cache")
-        exp_total_len, exp_warning_len, exp_error_len = self.update_expression_cache()
+        exp_total_len, exp_up_to_date_len, exp_warning_len, exp_error_len = self.update_expression_cache()
         update_expression_time = time.time() - s_time
         self.logger.info("finish update_expression_cache")
 
         # update dataset cache
         s_time = time.time()
         self.logger.info("start update_dataset_cache")
-        dset_total_len, dset_warning_len, dset_error_len = self.update_dataset_cache()
+        dset_total_len, dset_up_to_date_len, dset_warning_len, dset_error_len = self.update_dataset_cache()
         update_dataset_time = time.time() - s_time
         self.logger.info("finish update_dataset_cache")
 
@@ -152,6 +380,7 @@ class DataUpdater(object):
             f"update expression cache."
             f"\n\t total time: {update_expression_time}"
             f"\n\t total cache length: {exp_total_len}"
+            f"\n\t up to date cache length: {exp_up_to_date_len}"
             f"\n\t warning cache length: {exp_warning_len}"
             f"\n\t error cache length: {exp_error_len}"
         )
@@ -160,9 +389,12 @@ class DataUpdater(object):
             f"update dataset cache."
             f"\n\t total time: {update_dataset_time}"
             f"\n\t total cache length: {dset_total_len}"
+            f"\n\t up to date cache length: {dset_up_to_date_len}"
             f"\n\t warning cache length: {dset_warning_len}"
             f"\n\t error cache length: {dset_error_len}"
         )
+        # let the workers of the server drop their memory cache
+        notify_data_updated()
         # notify a queue
         if notify_func:
             notify_func()
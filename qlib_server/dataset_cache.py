@@ -0,0 +1,177 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+from __future__ import division
+from __future__ import print_function
+
+import stat
+import time
+import pickle
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+from .cache_index import get_cache_index
+
+from qlib.config import C as QC
+from qlib.utils import remove_fields_space
+from qlib.data.cache import DatasetCache, DiskDatasetCache
+
+
+def get_dataset_cache_uri(instruments, fields, freq, disk_cache=1):
+    """get the uri of the dataset cache generated by `D.features_uri`."""
+    return DiskDatasetCache._uri(instruments, fields, None, None, freq, disk_cache)
+
+
+def get_dataset_cache_path(cache_uri, freq):
+    from qlib.data.data import DatasetD
+
+    return Path(DatasetD.get_cache_dir(freq)).joinpath(cache_uri)
+
+
+def get_dataset_lock_name(cache_uri, freq):
+    """get the name of the redis lock of the dataset cache, the same as the one used by qlib."""
+    return f"{str(QC.dpm.get_data_uri(freq))}:dataset-{cache_uri}"
+
+
+def is_dataset_cache_fresh(cache_path, freq):
+    """Whether the dataset cache exists and has been updated to the latest calendar.
+
+    The cache index is looked up first, the meta file is read if the cache is not indexed as up to date.
+    """
+    from qlib.data.data import Cal
+
+    cache_path = Path(cache_path)
+    latest = str(Cal.calendar(freq=freq)[-1])
+    cache_index = get_cache_index()
+    if cache_index is not None:
+        entry = cache_index.get("dataset", freq, cache_path.name)
+        if entry is not None and entry.last_update == latest:
+            return True
+    if not DiskDatasetCache.check_cache_exists(cache_path):
+        return False
+    try:
+        with cache_path.with_suffix(".meta").open("rb") as f:
+            last_update = pickle.load(f)["info"]["last_update"]
+    except (OSError, EOFError, pickle.UnpicklingError, KeyError):
+        # the dataset cache is being removed or written
+        return False
+    if last_update != latest:
+        return False
+    if cache_index is not None:
+        # the dataset cache is updated by the others
+        cache_index.update_entry("dataset", freq, cache_path)
+    return True
+
+
+def write_dataset_cache(cache_path, features, instruments, freq):
+    """Write features as a dataset cache, the format is the same as `DiskDatasetCache.gen_dataset_cache`.
+
+    .. note:: This function does not consider the cache read write lock. Please
+        acquire the lock outside this function
+
+    :param cache_path: the path to store the cache
+    :param features: pd.DataFrame with <instrument, datetime> index, it should cover the whole calendar
+    :param instruments: the instruments recorded in the meta file, the cache will be updated with them
+    :param freq: the freq of the features
+    """
+    from qlib.data.data import Cal
+
+    cache_path = Path(cache_path)
+    DiskDatasetCache.clear_cache(cache_path)
+    if features.empty:
+        return
+
+    features = features.swaplevel("instrument", "datetime").sort_index()
+    # write cache data
+    with pd.HDFStore(str(cache_path.with_suffix(".data"))) as store:
+        cache_to_orig_map = dict(zip(remove_fields_space(features.columns), features.columns))
+        orig_to_cache_map = dict(zip(features.columns, remove_fields_space(features.columns)))
+        cache_features = features[list(cache_to_orig_map.values())].rename(columns=orig_to_cache_map)
+        cache_features = cache_features.loc[:, sorted(cache_features.columns)]
+        cache_features = cache_features.loc[:, ~cache_features.columns.duplicated()]
+        store.append(DatasetCache.HDF_KEY, cache_features, append=False)
+    # write meta file
+    meta = {
+        "info": {
+            "instruments": instruments,
+            "fields": list(cache_features.columns),
+            "freq": freq,
+            "last_update": str(Cal.calendar(freq=freq)[-1]),
+            "inst_processors": [],
+        },
+        "meta": {"last_visit": time.time(), "visits": 1},
+    }
+    with cache_path.with_suffix(".meta").open("wb") as f:
+        pickle.dump(meta, f, protocol=QC.dump_protocol_version)
+    cache_path.with_suffix(".meta").chmod(stat.S_IRWXU | stat.S_IRGRP | stat.S_IROTH)
+    # write index file
+    im = DiskDatasetCache.IndexManager(cache_path)
+    im.update(im.build_index_from_data(features))
+    # the cache is visible after it is completely written
+    cache_path.with_suffix(".data").rename(cache_path)
+
+
+def get_dataset_cache_rows(cache_path, start_time, end_time):
+    """get the range [start, stop) of the rows in [start_time, end_time] of a dataset cache, None if it's empty.
+
+    .. note:: This function does not consider the cache read write lock. Please
+        acquire the lock outside this function
+    """
+    im = DiskDatasetCache.IndexManager(cache_path)
+    index_data = im.get_index(start_time, end_time)
+    if index_data.shape[0] == 0:
+        return None
+    return index_data["start"].iloc[0].item(), index_data["end"].iloc[-1].item()
+
+
+def read_dataset_cache_rows(cache_path, start, stop, fields):
+    """Read the rows [start, stop) of a dataset cache.
+
+    The rows are in the order of datetime, the result has the same format as
+    `DiskDatasetCache.read_data_from_cache`.
+
+    .. note:: This function does not consider the cache read write lock. Please
+        acquire the lock outside this function
+    """
+    with pd.HDFStore(str(cache_path), mode="r") as store:
+        df = store.select(key=DatasetCache.HDF_KEY, start=start, stop=stop)
+    df = df.swaplevel("datetime", "instrument").sort_index()
+    return DiskDatasetCache.cache_to_origin_data(df, fields)
+
+
+def get_dataset_cache_version(cache_path):
+    """get the version of a dataset cache file, which changes whenever the file is rewritten or updated."""
+    st = Path(cache_path).stat()
+    return st.st_mtime_ns, st.st_size
+
+
+def read_dataset_cache_instruments(cache_path, instruments, fields):
+    """Read the rows of `instruments` in a dataset cache.
+
+    Only the instrument column is read to locate the rows, then the rows are selected by their coordinates,
+    the result has the same format as `DiskDatasetCache.read_data_from_cache`.
+
+    .. note:: This function does not consider the cache read write lock. Please
+        acquire the lock outside this function
+    """
+    with pd.HDFStore(str(cache_path), mode="r") as store:
+        coordinates = np.flatnonzero(store.select_column(DatasetCache.HDF_KEY, "instrument").isin(instruments).values)
+        df = store.select(key=DatasetCache.HDF_KEY, where=coordinates)
+    df = df.swaplevel("datetime", "instrument").sort_index()
+    return DiskDatasetCache.cache_to_origin_data(df, fields)
+
+
+def slice_dataset_cache(source_path, cache_path, instruments, fields, freq):
+    """Generate the dataset cache of `instruments` and `fields` from a dataset cache including all its data.
+
+    Only the rows of `instruments` are read if they are a list, otherwise the whole dataset cache is read.
+
+    .. note:: This function does not consider the cache read write lock. Please
+        acquire the locks of both of the caches outside this function
+    """
+    if isinstance(instruments, (list, tuple)):
+        features = read_dataset_cache_instruments(source_path, list(instruments), fields)
+    else:
+        features = DiskDatasetCache.read_data_from_cache(source_path, None, None, fields)
+    write_dataset_cache(cache_path, features, instruments, freq)
@@ -0,0 +1,76 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+from __future__ import division
+from __future__ import print_function
+
+import pickle
+import hashlib
+
+from .config import C
+from .utils import get_redis_connection
+from .dataset_cache import (
+    get_dataset_cache_path,
+    get_dataset_lock_name,
+    get_dataset_cache_rows,
+    get_dataset_cache_version,
+    read_dataset_cache_rows,
+)
+
+from qlib.data.cache import CacheUtils
+
+
+class FeatureStream(object):
+    """The features of a dataset cache streamed to a client in chunks.
+
+    Iterating it yields the chunks as pickled DataFrames(at most `C.stream_chunk_rows` rows each), the
+    client concatenates them and sorts the index to get the same DataFrame as reading the cache file.
+    After the iteration, `summary` is the final frame to verify the stream with.
+
+    The reader lock of the dataset cache is held only while a chunk is read, so a slow client doesn't block
+    the updates of the cache. If the cache file is changed between the chunks, the stream is aborted with
+    a `ValueError`, since the rows already sent may not match the rest of them.
+    """
+
+    def __init__(self, message_body):
+        """
+        :param message_body: the message of the feature_stream task, including the uri and freq of the
+                             dataset cache, and the fields, start_time and end_time of the request
+        """
+        self.uri = message_body["uri"]
+        self.freq = message_body["freq"]
+        self.fields = message_body["fields"]
+        self.start_time = None if message_body["start_time"] == "None" else message_body["start_time"]
+        self.end_time = None if message_body["end_time"] == "None" else message_body["end_time"]
+        self.sha256 = hashlib.sha256()
+        self.chunks = 0
+        self.rows = 0
+
+    def read_chunk(self, start, stop, version):
+        """Read the rows [start, stop) of the cache if its version is still `version`."""
+        with CacheUtils.reader_lock(get_redis_connection(), get_dataset_lock_name(self.uri, self.freq)):
+            cache_path = get_dataset_cache_path(self.uri, self.freq)
+            if get_dataset_cache_version(cache_path) != version:
+                raise ValueError("The dataset cache has been updated during the stream, please retry")
+            return read_dataset_cache_rows(cache_path, start, stop, self.fields)
+
+    def __iter__(self):
+        with CacheUtils.reader_lock(get_redis_connection(), get_dataset_lock_name(self.uri, self.freq)):
+            cache_path = get_dataset_cache_path(self.uri, self.freq)
+            version = get_dataset_cache_version(cache_path)
+            rows = get_dataset_cache_rows(cache_path, self.start_time, self.end_time)
+        if rows is None:
+            return
+        start, stop = rows
+        for chunk_start in range(start, stop, C.stream_chunk_rows):
+            df = self.read_chunk(chunk_start, min(chunk_start + C.stream_chunk_rows, stop), version)
+            chunk = pickle.dumps(df, protocol=pickle.HIGHEST_PROTOCOL)
+            self.sha256.update(chunk)
+            self.chunks += 1
+            self.rows += len(df)
+            yield chunk
+
+    @property
+    def summary(self):
+        """The number of chunks and rows, and the sha256 of all the chunks."""
+        return {"chunks": self.chunks, "rows": self.rows, "sha256": self.sha256.hexdigest()}
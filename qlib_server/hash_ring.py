@@ -0,0 +1,159 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+from __future__ import division
+from __future__ import print_function
+
+import time
+import bisect
+import hashlib
+import threading
+
+from .config import C
+from .utils import get_redis_connection, init_rabbitmq_channel, hash_args, get_node_queue
+
+from qlib.log import get_module_logger
+
+# the sorted set of the data processor nodes scored by their last heartbeats
+PROCESSORS_KEY = "qlib_server:processors"
+
+
+class HashRing(object):
+    """Consistent hash ring of nodes.
+
+    Each node is placed on the ring `replicas` times, so the keys are balanced between the nodes and only
+    about 1/n of them move when a node joins or leaves.
+    """
+
+    def __init__(self, nodes, replicas=64):
+        ring = sorted((self.hash("%s#%d" % (node, i)), node) for node in nodes for i in range(replicas))
+        self._hashes = [h for h, _ in ring]
+        self._nodes = [node for _, node in ring]
+
+    @staticmethod
+    def hash(key):
+        return int(hashlib.md5(key.encode()).hexdigest()[:16], 16)
+
+    def get_node(self, key):
+        """get the node of `key`, None if there is no node."""
+        if not self._nodes:
+            return None
+        return self._nodes[bisect.bisect(self._hashes, self.hash(key)) % len(self._nodes)]
+
+
+def get_alive_processors():
+    """get the data processor nodes which sent heartbeats recently."""
+    deadline = time.time() - C.processor_heartbeat * 3
+    return [node.decode() for node in get_redis_connection().zrangebyscore(PROCESSORS_KEY, deadline, "+inf")]
+
+
+def get_routing_key(task_type, task_args, task_uri):
+    """get the key of a task on the hash ring, by its uri or its instruments(`C.processor_routing_key`)."""
+    if C.processor_routing_key == "instruments" and "instruments" in task_args:
+        return hash_args(task_args["instruments"], task_args["freq"])
+    return task_uri
+
+
+class ProcessorRing(object):
+    """The hash ring of the alive data processor nodes.
+
+    The ring is refreshed every `C.processor_heartbeat` seconds, the tasks routed to a node which has just
+    left are moved back to the shared queues by `ProcessorMembership` of the other nodes.
+    """
+
+    def __init__(self):
+        self.logger = get_module_logger(self.__class__.__name__)
+        self._lock = threading.Lock()
+        self._ring = HashRing([])
+        self._refresh_time = 0
+
+    def refresh(self):
+        with self._lock:
+            if time.time() - self._refresh_time < C.processor_heartbeat:
+                return
+            try:
+                self._ring = HashRing(get_alive_processors(), C.hash_ring_replicas)
+            except Exception as e:
+                self.logger.warning("Failed to refresh the hash ring of the data processors: %s" % e)
+            self._refresh_time = time.time()
+
+    def route(self, task_queue, task_type, task_args, task_uri):
+        """get the queue of the node of a task in `task_queue`, `task_queue` itself if there is no node."""
+        self.refresh()
+        node = self._ring.get_node(get_routing_key(task_type, task_args, task_uri))
+        return task_queue if node is None else get_node_queue(task_queue, node)
+
+
+class ProcessorMembership(threading.Thread):
+    """Keep a data processor node in the hash ring and rebalance the tasks of the dead nodes.
+
+    The node sends a heartbeat every `C.processor_heartbeat` seconds. A node without heartbeats for
+    3 intervals is removed from the ring by the listeners, and the tasks left in its queues are moved
+    to the shared queues by the other nodes, which consume the shared queues too.
+    """
+
+    def __init__(self, node, task_queues):
+        """
+        :param node: the id of this node
+        :param task_queues: the shared task queues of which the node has its own queues
+        """
+        super(ProcessorMembership, self).__init__(name="processor-membership", daemon=True)
+        self.logger = get_module_logger(self.__class__.__name__)
+        self.node = node
+        self.task_queues = task_queues
+
+    def heartbeat(self):
+        get_redis_connection().zadd(PROCESSORS_KEY, {self.node: time.time()})
+
+    def leave(self):
+        """Leave the ring and move the tasks left in the queues of the node to the shared queues.
+
+        The node is marked as dead instead of being removed, so the other nodes keep moving the tasks
+        routed to it by the listeners with stale rings until it is removed by `rebalance`.
+        """
+        get_redis_connection().zadd(PROCESSORS_KEY, {self.node: time.time() - C.processor_heartbeat * 3 - 1})
+        for task_queue in self.task_queues:
+            self.move_tasks(get_node_queue(task_queue, self.node), task_queue)
+
+    def move_tasks(self, source, target):
+        """Move the tasks in queue `source` to queue `target`."""
+        channel = init_rabbitmq_channel(C.queue_host, C.queue_user, C.queue_pwd)
+        try:
+            channel.queue_declare(queue=source, durable=True)
+            n_tasks = 0
+            while True:
+                method, properties, body = channel.basic_get(queue=source)
+                if method is None:
+                    break
+                channel.basic_publish(exchange="", routing_key=target, body=body)
+                channel.basic_ack(delivery_tag=method.delivery_tag)
+                n_tasks += 1
+            if n_tasks:
+                self.logger.info("move %d tasks from %s to %s" % (n_tasks, source, target))
+        finally:
+            channel.connection.close()
+
+    def rebalance(self):
+        """Move the tasks of the dead nodes to the shared queues."""
+        redis_t = get_redis_connection()
+        deadline = time.time() - C.processor_heartbeat * 3
+        for node in redis_t.zrangebyscore(PROCESSORS_KEY, "-inf", deadline):
+            node = node.decode()
+            # only one node moves the tasks of a dead node at a time
+            if not redis_t.set("%s:rebalance:%s" % (PROCESSORS_KEY, node), self.node, nx=True, ex=60):
+                continue
+            for task_queue in self.task_queues:
+                self.move_tasks(get_node_queue(task_queue, node), task_queue)
+            # the listeners with a stale ring may still route tasks to the dead node for a while
+            score = redis_t.zscore(PROCESSORS_KEY, node)
+            if score is not None and score < deadline - C.processor_heartbeat * 10:
+                redis_t.zrem(PROCESSORS_KEY, node)
+
+    def run(self):
+        while True:
+            try:
+                self.heartbeat()
+                self.rebalance()
+            except Exception as e:
+                self.logger.warning("Failed to keep the membership of the data processor: %s" % e)
+            time.sleep(C.processor_heartbeat)
@@ -0,0 +1,184 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+from __future__ import division
+from __future__ import print_function
+
+import os
+import pika
+import queue
+import threading
+
+from .config import C
+from .utils import init_rabbitmq_channel
+
+from qlib.log import get_module_logger
+
+# the errors after which the channel should be reconnected
+CONNECTION_ERRORS = (pika.exceptions.AMQPConnectionError, pika.exceptions.AMQPChannelError)
+
+
+class PublishError(Exception):
+    """The messages of a batch which are not published.
+
+    :param messages: the messages which may not have reached the broker, the tail of the batch
+    """
+
+    def __init__(self, messages, cause):
+        super(PublishError, self).__init__("failed to publish %d messages: %r" % (len(messages), cause))
+        self.messages = messages
+
+
+class RabbitMQChannel(object):
+    """A rabbitmq channel which is reconnected automatically.
+
+    The connection is opened with heartbeats(`C.queue_heartbeat`), a long-lived publisher should call
+    `process_data_events` periodically to respond to the heartbeats. If the connection is lost anyway,
+    it will be reopened on the next publishing.
+    If `C.queue_confirm` is set, the messages are published in transactions, so a batch of messages
+    is confirmed by the broker in one round trip.
+
+    .. note:: pika channels are not thread-safe, a channel should be used by one thread at a time.
+    """
+
+    def __init__(self, queues=(), prefetch_count=None):
+        self.queues = queues
+        self.prefetch_count = prefetch_count
+        self.logger = get_module_logger(self.__class__.__name__)
+        self._channel = None
+
+    @property
+    def channel(self):
+        if self._channel is None or not self._channel.is_open:
+            self.close()
+            self._channel = init_rabbitmq_channel(C.queue_host, C.queue_user, C.queue_pwd)
+            for queue in self.queues:
+                self._channel.queue_declare(queue=queue, durable=True)
+            if self.prefetch_count is not None:
+                self._channel.basic_qos(prefetch_count=self.prefetch_count)
+            if C.queue_confirm:
+                self._channel.tx_select()
+        return self._channel
+
+    def publish(self, routing_key, body):
+        """Publish a message to the queue `routing_key`."""
+        self.publish_batch([(routing_key, body)])
+
+    def publish_batch(self, messages):
+        """Publish a batch of messages.
+
+        The batch is retried once after reconnecting. The retry resumes from the first message which is not
+        handed to the broker yet, so no message is published twice; in transactions the uncommitted messages
+        are rolled back, so the whole batch is retried.
+
+        :param messages: list of (routing_key, body)
+        :raise PublishError: with the messages which are not published if the retry fails too
+        """
+        sent = 0
+        for retry in range(2):
+            try:
+                channel = self.channel
+                for routing_key, body in messages[sent:]:
+                    channel.basic_publish(exchange="", routing_key=routing_key, body=body)
+                    if not C.queue_confirm:
+                        sent += 1
+                if C.queue_confirm:
+                    channel.tx_commit()
+                return
+            except CONNECTION_ERRORS as e:
+                self.close()
+                if retry:
+                    raise PublishError(messages[sent:], e) from e
+                self.logger.warning("rabbitmq connection is lost(%r), reconnect..." % e)
+
+    def process_data_events(self, time_limit=0):
+        """Respond to the heartbeats of the connection."""
+        if self._channel is not None and self._channel.is_open:
+            try:
+                self._channel.connection.process_data_events(time_limit=time_limit)
+            except CONNECTION_ERRORS as e:
+                self.logger.warning("rabbitmq connection is lost(%r), it will be reconnected" % e)
+                self.close()
+
+    def close(self):
+        if self._channel is not None:
+            try:
+                self._channel.connection.close()
+            except Exception:
+                pass
+            self._channel = None
+
+
+_CHANNEL_POOL = {}
+_CHANNEL_POOL_LOCK = threading.Lock()
+
+
+def get_channel(name, queues=(), prefetch_count=None):
+    """Get the channel `name` from the channel pool of current process.
+
+    The channels are not shared between processes, so the channels are reopened in the forked processes.
+    """
+    key = (os.getpid(), name)
+    with _CHANNEL_POOL_LOCK:
+        if key not in _CHANNEL_POOL:
+            _CHANNEL_POOL[key] = RabbitMQChannel(queues, prefetch_count)
+        return _CHANNEL_POOL[key]
+
+
+class Publisher(threading.Thread):
+    """Publish messages in a dedicated thread.
+
+    The producers only put messages into a bounded in-memory queue. This thread is the only one using
+    the channel, it publishes the queued messages in micro-batches(at most `C.publisher_batch_size`
+    messages per batch) and responds to the heartbeats while it is idle.
+
+    The messages which fail to be published are passed to `on_error`, so the producer can answer the
+    clients waiting for them.
+    """
+
+    def __init__(self, name, queues=(), on_error=None):
+        """
+        :param on_error: callback(messages) with the list of the (routing_key, body, context) not published
+        """
+        super(Publisher, self).__init__(name="%s-publisher" % name, daemon=True)
+        self.logger = get_module_logger(self.__class__.__name__)
+        self.on_error = on_error
+        self.queue = queue.Queue(maxsize=C.publisher_queue_size)
+        # the connection is opened lazily in the publisher thread
+        self.channel = RabbitMQChannel(queues)
+
+    def put(self, routing_key, body, context=None):
+        """Put a message into the queue to be published.
+
+        :param context: passed back to `on_error` if the message fails to be published
+        :raise queue.Full: if the queue is still full after waiting `C.publisher_put_timeout` seconds
+        """
+        self.queue.put((routing_key, body, context), timeout=C.publisher_put_timeout)
+
+    def run(self):
+        idle_timeout = C.queue_heartbeat / 4 if C.queue_heartbeat else None
+        while True:
+            try:
+                messages = [self.queue.get(timeout=idle_timeout)]
+            except queue.Empty:
+                self.channel.process_data_events()
+                continue
+            while len(messages) < C.publisher_batch_size:
+                try:
+                    messages.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.channel.publish_batch([(routing_key, body) for routing_key, body, _ in messages])
+                continue
+            except PublishError as e:
+                failed = messages[len(messages) - len(e.messages) :]
+                self.logger.error("Failed to publish %d messages: %r" % (len(failed), e.__cause__))
+            except Exception as e:
+                failed = messages
+                self.logger.error("Failed to publish %d messages: %r" % (len(failed), e))
+            if self.on_error is not None:
+                try:
+                    self.on_error(failed)
+                except Exception as e:
+                    self.logger.error("Failed to report the messages not published: %r" % e)
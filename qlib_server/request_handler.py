@@ -6,6 +6,7 @@ from __future__ import print_function
 
 import time
 import json
+import queue
 import threading
 from packaging import version
 from flask import Flask, request
@@ -13,7 +14,22 @@ from flask_socketio import SocketIO
 from packaging.specifiers import SpecifierSet
 
 from .config import C
-from .utils import init_rabbitmq_channel, get_redis_connection
+from .codec import encode, encode_message, decode_message, load_raw, PacketJSON, RawJSON
+from .data_index import DataIndex
+from .feature_stream import FeatureStream
+from .hash_ring import ProcessorRing
+from .rabbitmq import Publisher, CONNECTION_ERRORS
+from .utils import (
+    init_rabbitmq_channel,
+    get_redis_connection,
+    subscribe_data_update,
+    get_task_queue,
+    get_task_queues,
+    get_task_uri,
+    get_raw_task_uri,
+    get_reply_queue,
+    get_result_memo,
+)
 
 from qlib.log import get_module_logger
 
@@ -27,8 +43,14 @@ class RequestListener(threading.Thread):
 
         - establish connections with clients
         - listens to requests from clients
-        - get a unique task_uri for a request
-        - publish the request as a task to rabbitmq
+        - answer calendar and instrument requests with the in-process indexes
+        - answer calendar and instrument requests with the memo of the identical tasks completed recently
+        - get a unique canonical task_uri for a request
+        - estimate the cost of the request and publish it as a task to the queue of its lane
+        - if `C.processor_routing` is enabled, publish it to the queue of its data processor node instead
+
+    The socket.io handlers never use the rabbitmq channel directly, the tasks and messages are
+    published by a dedicated `Publisher` thread.
     """
 
     def __init__(self, socketio, app):
@@ -39,11 +61,18 @@ class RequestListener(threading.Thread):
         self.app = app
 
         # define server instances
-        self.channel = init_rabbitmq_channel(C.queue_host, C.queue_user, C.queue_pwd)
-        self.channel.queue_declare(queue=C.task_queue, durable=True)
-        self.channel.queue_declare(queue=C.message_queue, durable=True)
+        self.publisher = Publisher(
+            "listener", queues=list(get_task_queues()) + [get_reply_queue()], on_error=self.on_publish_failed
+        )
         self.logger = get_module_logger(self.__class__.__name__)
         self.redis_t = get_redis_connection()
+        self.data_index = DataIndex()
+        self.processor_ring = ProcessorRing()
+
+    def on_data_updated(self):
+        """Callback function when the data updater finished updating the data."""
+        self.logger.info("data updated, reload the indexes")
+        self.data_index.reload()
 
     def on_connect(self):
         """Callback function when the server accepted a connection from a client."""
@@ -62,6 +91,56 @@ class RequestListener(threading.Thread):
         if not spec.contains(version.parse(v), prereleases=True):
             raise Exception("Client version mismatch, please upgrade your qlib client ({})".format(ver))
 
+    @staticmethod
+    def encode_task(task_type, request_body, client_ssid, task_uri=None):
+        meta = {
+            "type": task_type,
+            "ssid": client_ssid,
+            "task_uri": task_uri,
+            "raw_uri": get_raw_task_uri(task_type, request_body),
+            "reply_queue": get_reply_queue(),
+        }
+        return encode({"meta": meta, "args": request_body})
+
+    @staticmethod
+    def encode_message(message_type, message_body, status_code, ssids, detailed_info=None):
+        return encode_message(
+            {"type": message_type, "ssids": ssids, "status": status_code, "detailed_info": detailed_info},
+            message_body,
+        )
+
+    def enqueue(self, routing_key, body, message_type, ssid, room=None):
+        """Put a message into the queue of the publisher.
+
+        The client is responded with an error if the server is too busy to publish it.
+
+        :param room: the room of the task the client has joined, it is left if the message is not published
+        :return: whether the message is put into the queue
+        """
+        try:
+            self.publisher.put(routing_key, body, (message_type, ssid, room))
+            return True
+        except queue.Full:
+            self.logger.error("The publisher queue is full, reject the %s request of client %s" % (message_type, ssid))
+            self.reject(message_type, ssid, room, "The server is busy, please retry later")
+            return False
+
+    def reject(self, message_type, ssid, room, detailed_info):
+        if room is not None:
+            self.socketio.server.leave_room(ssid, room, namespace="/")
+        self.socketio.emit(
+            "%s_response" % message_type, {"result": None, "status": 1, "detailed_info": detailed_info}, room=ssid
+        )
+
+    def on_publish_failed(self, messages):
+        """Callback function when the publisher failed to publish some messages.
+
+        The clients of the messages are responded with errors instead of waiting for the responses forever.
+        """
+        for _, _, (message_type, ssid, room) in messages:
+            self.logger.error("Failed to publish the %s message of client %s" % (message_type, ssid))
+            self.reject(message_type, ssid, room, "Failed to publish the request, please retry later")
+
     def publish_task(self, task_type, request_body, client_ssid):
         """Publish a task to rabbitmq task_queue.
 
@@ -75,16 +154,33 @@ class RequestListener(threading.Thread):
             {
                 'type': 'calendar'/'instrument'/'feature',
                 'ssid': client session_id,
+                'task_uri': the canonical uri of the task,
+                'raw_uri': the uri of the task before canonicalization,
+                'reply_queue': the queue of the messages to the client,
                 **request_body
             }
+
+        The client joins the room `task_uri` of the clients waiting for the same task, and leaves it when
+        it is answered.
         """
         time_logger.debug("publish task to queue at %f" % time.time())
         self.logger.info("Publish %s task to rabbitmq" % task_type)
-        self.channel.basic_publish(
-            exchange="",
-            routing_key=C.task_queue,
-            body=json.dumps({"meta": {"type": task_type, "ssid": client_ssid}, "args": request_body}).encode("utf-8"),
-        )
+        task_uri = get_task_uri(task_type, request_body)
+        if self.respond_from_memo(task_type, task_uri, client_ssid):
+            return
+        # the clients waiting for the same task are in the room of the task until they are answered,
+        # the features are streamed to each client separately
+        room = task_uri if task_type != "feature_stream" else None
+        if room is not None:
+            self.socketio.server.enter_room(client_ssid, room, namespace="/")
+        # the cheap tasks should not wait behind the heavy ones
+        lane = self.data_index.route(task_type, request_body) if C.task_routing else None
+        task_queue = get_task_queue(lane)
+        if C.processor_routing:
+            # the identical or overlapping tasks are processed on the same node
+            task_queue = self.processor_ring.route(task_queue, task_type, request_body, task_uri)
+        body = self.encode_task(task_type, request_body, client_ssid, task_uri)
+        self.enqueue(task_queue, body, task_type, client_ssid, room)
         time_logger.debug("finish publishing task to queue at %f" % time.time())
 
     def publish_message(self, message_type, message_body, status_code, ssid, detailed_info=None):
@@ -130,19 +226,44 @@ class RequestListener(threading.Thread):
         The data processor could send some detailed_info to the client
         """
         self.logger.info("Publish %s message [%s] to rabbitmq" % (message_type, str(message_body)[:200]))
-        self.channel.basic_publish(
-            exchange="",
-            routing_key=C.message_queue,
-            body=json.dumps(
-                {
-                    "type": message_type,
-                    "data": message_body,
-                    "ssids": [ssid],
-                    "status": status_code,
-                    "detailed_info": detailed_info,
-                }
-            ).encode("utf-8"),
+        self.enqueue(
+            get_reply_queue(),
+            self.encode_message(message_type, message_body, status_code, [ssid], detailed_info),
+            message_type,
+            ssid,
+        )
+
+    def respond_from_index(self, task_type, request_body, ssid):
+        """Respond to a request with the in-process indexes directly.
+
+        :return: False if the indexes can't answer the request and a task should be published
+        """
+        result = self.data_index.query(task_type, request_body)
+        if result is None:
+            return False
+        time_logger.debug("respond %s request from index at %f" % (task_type, time.time()))
+        self.socketio.emit("%s_response" % task_type, {"result": result, "status": 0, "detailed_info": None}, room=ssid)
+        return True
+
+    def respond_from_memo(self, task_type, task_uri, ssid):
+        """Respond to a request with the memo of the result of an identical task completed recently.
+
+        :return: False if there is no memo and a task should be published
+        """
+        if not C.result_memo_ttl or task_type not in ["calendar", "instrument"]:
+            return False
+        try:
+            memo = get_result_memo(task_uri)
+        except Exception as e:
+            self.logger.warning("Failed to get the result memo of task %s: %s" % (task_uri, e))
+            return False
+        if memo is None:
+            return False
+        time_logger.debug("respond %s request from memo at %f" % (task_type, time.time()))
+        self.socketio.emit(
+            "%s_response" % task_type, {"result": RawJSON(memo), "status": 0, "detailed_info": None}, room=ssid
         )
+        return True
 
     def on_calendar_request_received(self, calendar_request_body):
         """Callback function when the server received a calendar request from a client.
@@ -167,6 +288,8 @@ class RequestListener(threading.Thread):
             self.logger.error(e)
             self.publish_message("calendar", None, 1, request.sid, str(e))
         else:
+            if self.respond_from_index("calendar", body, request.sid):
+                return
             self.publish_task("calendar", body, request.sid)
 
     def on_instrument_request_received(self, instrument_request_body):
@@ -193,6 +316,8 @@ class RequestListener(threading.Thread):
             self.logger.error(e)
             self.publish_message("instrument", None, 1, request.sid, str(e))
         else:
+            if self.respond_from_index("instrument", body, request.sid):
+                return
             self.publish_task("instrument", body, request.sid)
 
     def on_feature_request_received(self, feature_request_body):
@@ -222,9 +347,32 @@ class RequestListener(threading.Thread):
         else:
             self.publish_task("feature", body, request.sid)
 
+    def on_feature_stream_request_received(self, feature_request_body):
+        """Callback function when the server received a feature stream request from a client.
+
+        The request is the same as the feature request, but the features are streamed to the client
+        instead of responding the uri of the dataset cache, so the client doesn't need to mount the
+        `provider_uri` of the server.
+        """
+        time_logger.debug("receive feature stream request at %f" % time.time())
+        body = json.loads(feature_request_body["body"])
+        self.logger.info("Received feature stream request from client: %.200s" % body)
+        try:
+            self.check_version(feature_request_body["head"]["version"])
+        except Exception as e:
+            self.logger.error(e)
+            self.publish_message("feature_stream", None, 1, request.sid, str(e))
+        else:
+            self.publish_task("feature_stream", body, request.sid)
+
     def run(self):
         """Start the process that binds the callback functions."""
         self.logger.info("request listener module start...")
+        self.publisher.start()
+
+        # load the indexes and reload them after the data is updated
+        subscribe_data_update(self.on_data_updated)
+        self.data_index.load()
 
         # bind socketio callbacks
         self.socketio.on_event("connect", self.on_connect)
@@ -232,6 +380,7 @@ class RequestListener(threading.Thread):
         self.socketio.on_event("calendar_request", self.on_calendar_request_received)
         self.socketio.on_event("instrument_request", self.on_instrument_request_received)
         self.socketio.on_event("feature_request", self.on_feature_request_received)
+        self.socketio.on_event("feature_stream_request", self.on_feature_stream_request_received)
         self.socketio.run(self.app, host="0.0.0.0", port=C.flask_port)
 
 
@@ -250,7 +399,14 @@ class RequestResponder(threading.Thread):
         super(RequestResponder, self).__init__()
         self.socketio = socketio
         self.logger = get_module_logger(self.__class__.__name__)
-        self.channel = init_rabbitmq_channel(C.queue_host, C.queue_user, C.queue_pwd)
+
+    @staticmethod
+    def decode_message(body):
+        """Decode the header of a message.
+
+        :return: (header, data), the data is forwarded to the clients without being decoded
+        """
+        return decode_message(body)
 
     def message_callback(self, ch, method, properties, body):
         """Callback function when a task is finished and a published message is received.
@@ -260,17 +416,18 @@ class RequestResponder(threading.Thread):
                   the message is successfully consumed.
         """
         time_logger.debug("receive message from queue at %f" % time.time())
-        mbody = json.loads(body.decode("utf-8"))
-        mtype = mbody["type"]
-        mssids = mbody["ssids"]
-        mdata = mbody["data"]
-        mstatus = mbody["status"]
-        detailed_info = mbody["detailed_info"]
-
-        self.logger.info("Receive %s message '%.200s'" % (mtype, mbody))
+        mheader, mdata = self.decode_message(body)
+        mtype = mheader["type"]
+        mssids = mheader["ssids"]
+        mstatus = mheader["status"]
+        detailed_info = mheader["detailed_info"]
+
+        self.logger.info("Receive %s message for %d clients" % (mtype, len(mssids)))
         time_logger.debug("respond to clients at %f" % time.time())
         if mtype in ["calendar", "instrument", "feature"]:
-            self.respond(mtype, mssids, mdata, mstatus, detailed_info)
+            self.respond(mtype, mssids, mdata, mstatus, detailed_info, mheader.get("room"))
+        elif mtype == "feature_stream":
+            self.respond_stream(mssids, load_raw(mdata), mstatus, detailed_info)
         else:
             self.logger.warning("Unrecognized message type!")
         # mark the task as completion
@@ -278,7 +435,7 @@ class RequestResponder(threading.Thread):
 
         time_logger.debug("finish responding to clients at %f" % time.time())
 
-    def respond(self, message_type, client_ssids, data, status=0, detailed_info=None):
+    def respond(self, message_type, client_ssids, data, status=0, detailed_info=None, room=None):
         """Respond to clients with data.
 
         The response is formatted as below:
@@ -309,21 +466,88 @@ class RequestResponder(threading.Thread):
                 'result': uri,
                 'status': 0(success)/1(invalid uri)
             }
+
+        The response is emitted to all the clients at once, so it's encoded only once.
+        If the message is of a task published by the listener, the answered clients leave the room of the task.
+        The room is not closed, since the clients joining it meanwhile are answered by their own messages.
         """
+        response = {"result": data, "status": status, "detailed_info": detailed_info}
+        self.logger.info("Send %s response to clients %s" % (message_type, client_ssids))
+        self.socketio.emit("%s_response" % message_type, response, room=list(client_ssids))
+        if room is not None:
+            for ssid in client_ssids:
+                self.socketio.server.leave_room(ssid, room, namespace="/")
+
+    def respond_stream(self, client_ssids, data, status=0, detailed_info=None):
+        """Stream the features to clients, each client is streamed in a background task."""
         for ssid in client_ssids:
-            # respond to all clients
-            self.logger.info("Send %s response to client %s" % (message_type, ssid))
-            self.socketio.emit(
-                "%s_response" % message_type,
-                {"result": data, "status": status, "detailed_info": detailed_info},
-                room=ssid,
-            )
+            if status != 0:
+                self.respond("feature_stream", [ssid], None, status, detailed_info)
+            else:
+                self.socketio.start_background_task(self.stream_features, ssid, data)
+
+    def stream_features(self, ssid, data):
+        """Stream the features to a client.
+
+        The stream is formatted as below:
+
+        A `feature_stream_chunk` event for each chunk, the client should acknowledge it by returning from
+        the event handler. At most `C.stream_window` chunks are sent before they are acknowledged.
+
+        .. code-block:: pickle
+
+            {
+                'seq': sequence number of the chunk,
+                'data': pickled DataFrame
+            }
+
+        Then a `feature_stream_response` event to finish the stream.
+
+        .. code-block:: pickle
+
+            {
+                'result': {'chunks': number of chunks, 'rows': number of rows, 'sha256': sha256 of the chunks},
+                'status': 0(success)/1(failed),
+                'detailed_info': None
+            }
+        """
+        self.logger.info("Stream features to client %s" % ssid)
+        # the acknowledgements of the chunks, the window is waited with the sleep of the async mode of
+        # socketio, so it works with the threads, eventlet and gevent alike
+        acks = []
+        stream = FeatureStream(data)
+        try:
+            for seq, chunk in enumerate(stream):
+                deadline = time.time() + C.stream_ack_timeout
+                while seq - len(acks) >= C.stream_window:
+                    if time.time() > deadline:
+                        raise TimeoutError("The client doesn't acknowledge the chunks of the stream")
+                    self.socketio.sleep(0.01)
+                self.socketio.emit(
+                    "feature_stream_chunk",
+                    {"seq": seq, "data": chunk},
+                    room=ssid,
+                    callback=lambda *args: acks.append(None),
+                )
+        except Exception as e:
+            self.logger.exception(f"Error while streaming features %.200s" % e)
+            self.respond("feature_stream", [ssid], None, 1, str(e))
+        else:
+            time_logger.debug("finish streaming features at %f" % time.time())
+            self.respond("feature_stream", [ssid], stream.summary)
 
     def run(self):
         """Start the process that listens to message_queue and respond to clients."""
         self.logger.info("request responder module start...")
-        self.channel.basic_consume(on_message_callback=self.message_callback, queue=C.message_queue)
-        self.channel.start_consuming()
+        while True:
+            try:
+                channel = init_rabbitmq_channel(C.queue_host, C.queue_user, C.queue_pwd)
+                channel.queue_declare(queue=get_reply_queue(), durable=True)
+                channel.basic_consume(on_message_callback=self.message_callback, queue=get_reply_queue())
+                channel.start_consuming()
+            except CONNECTION_ERRORS as e:
+                self.logger.warning("rabbitmq connection is lost(%r), reconnect..." % e)
+                time.sleep(1)
 
 
 class RequestHandler(object):
@@ -331,11 +555,20 @@ class RequestHandler(object):
 
     Combined `RequestListener` and `RequestResponder`.
     Communicate with clients.
+    Several request handler nodes can serve the clients behind a load balancer. The results are published
+    to the reply queue of the nodes where the waiting clients connect, or if the nodes share a socket.io
+    message queue(`C.socketio_message_queue`), to `C.message_queue` and emitted by any of the nodes.
     """
 
     def __init__(self):
         self.app = Flask(__name__)
-        self.socketio = SocketIO(self.app, ping_interval=C.flask_ping_interval)
+        # the data of the messages is spliced into the packets without being decoded and encoded again
+        self.socketio = SocketIO(
+            self.app,
+            ping_interval=C.flask_ping_interval,
+            json=PacketJSON,
+            message_queue=C.socketio_message_queue,
+        )
         self.request_listener = RequestListener(self.socketio, self.app)
         self.request_responder = RequestResponder(self.socketio)
 
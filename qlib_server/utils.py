@@ -5,82 +5,450 @@
 from __future__ import division
 from __future__ import print_function
 
+import os
 import json
+import uuid
 import pika
 import redis
+import socket
 import hashlib
-import redis_lock
+import threading
 
 from .config import C
 
+import pandas as pd
+from qlib.data.data import DatasetD
 
 # ################### Server ####################
+_REDIS_POOL = None
+_REDIS_SCRIPTS = {}
 
 
 def get_redis_connection():
-    """get redis connection instance."""
-    return redis.StrictRedis(host=C.redis_host, port=C.redis_port, db=C.redis_task_db)
+    """get redis connection instance.
+
+    All the connection instances of a process share one connection pool.
+    """
+    global _REDIS_POOL
+    if _REDIS_POOL is None:
+        _REDIS_POOL = redis.ConnectionPool(host=C.redis_host, port=C.redis_port, db=C.redis_task_db)
+    return redis.StrictRedis(connection_pool=_REDIS_POOL)
+
+
+def get_redis_script(script):
+    """get a registered lua script, it will be run with EVALSHA."""
+    if script not in _REDIS_SCRIPTS:
+        _REDIS_SCRIPTS[script] = get_redis_connection().register_script(script)
+    return _REDIS_SCRIPTS[script]
 
 
 def init_rabbitmq_channel(host, user, pwd):
     """init rabbitmq channel for task distribution."""
     user_pwd = pika.PlainCredentials(user, pwd)
-    connection = pika.BlockingConnection(pika.ConnectionParameters(host, credentials=user_pwd, heartbeat=0))
+    connection = pika.BlockingConnection(
+        pika.ConnectionParameters(
+            host,
+            credentials=user_pwd,
+            heartbeat=C.queue_heartbeat,
+            blocked_connection_timeout=C.queue_blocked_timeout,
+        )
+    )
     channel = connection.channel()
     return channel
 
 
-def add_to_task_l_and_check_qlen(task_uri, ssid):
+METRICS_KEY = "qlib_server:metrics"
+
+# The lua scripts run atomically in redis, so no lock is needed and each call is one round trip.
+# The task list outlives its lease, so the clients waiting on a dead worker are answered by the one taking over.
+# KEYS: task list, task lease, metrics, raw uris of the task
+# ARGV: ssid, lease token, lease ttl(ms), raw uri of the request
+# return: 0 if the task is being processed, 1 if the task is acquired, 2 if the task is taken over
+ADD_TASK_SCRIPT = """
+local qlen = redis.call('lpush', KEYS[1], ARGV[1])
+local new_raw = ARGV[4] ~= '' and redis.call('sadd', KEYS[4], ARGV[4]) == 1
+local ret = 1
+if qlen > 1 then
+    if redis.call('exists', KEYS[2]) == 1 then
+        if new_raw and redis.call('scard', KEYS[4]) > 1 then
+            -- the request is merged only because the uris are canonical
+            redis.call('hincrby', KEYS[3], 'canonical_merged', 1)
+        end
+        return 0
+    end
+    -- the lease of the task has expired, the worker processing it must have died
+    redis.call('hincrby', KEYS[3], 'lease_expired', 1)
+    ret = 2
+end
+redis.call('set', KEYS[2], ARGV[2], 'PX', ARGV[3])
+redis.call('pexpire', KEYS[1], ARGV[3] * 10)
+redis.call('pexpire', KEYS[4], ARGV[3] * 10)
+return ret
+"""
+
+# KEYS: task list, task lease, raw uris of the task, tasks parked on the task
+# ARGV: lease token, lease ttl(ms)
+RENEW_TASK_SCRIPT = """
+if redis.call('get', KEYS[2]) ~= ARGV[1] then
+    return 0
+end
+redis.call('pexpire', KEYS[2], ARGV[2])
+redis.call('pexpire', KEYS[1], ARGV[2] * 10)
+redis.call('pexpire', KEYS[3], ARGV[2] * 10)
+redis.call('pexpire', KEYS[4], ARGV[2] * 10)
+return 1
+"""
+
+# KEYS: task list, task lease, metrics
+# ARGV: lease token, lease ttl(ms)
+# return: 0 if the task is being processed, 1 if the task has been finished, 2 if the task is taken over
+TAKE_OVER_TASK_SCRIPT = """
+if redis.call('exists', KEYS[2]) == 1 then
+    return 0
+end
+if redis.call('exists', KEYS[1]) == 0 then
+    return 1
+end
+redis.call('hincrby', KEYS[3], 'lease_expired', 1)
+redis.call('set', KEYS[2], ARGV[1], 'PX', ARGV[2])
+redis.call('pexpire', KEYS[1], ARGV[2] * 10)
+return 2
+"""
+
+# KEYS: task list, task lease, raw uris of the task
+POP_TASK_SCRIPT = """
+local ssids = redis.call('lrange', KEYS[1], 0, -1)
+redis.call('del', KEYS[1], KEYS[2], KEYS[3])
+return ssids
+"""
+
+
+def incr_metric(name, amount=1):
+    """increase a counter of the server metrics."""
+    get_redis_connection().hincrby(METRICS_KEY, name, amount)
+
+
+def get_metrics():
+    """get all the counters of the server metrics."""
+    return {k.decode(): int(v) for k, v in get_redis_connection().hgetall(METRICS_KEY).items()}
+
+
+def get_task_lease_key(task_uri):
+    return "%s:lease" % task_uri
+
+
+def get_task_raw_uris_key(task_uri):
+    return "%s:raw" % task_uri
+
+
+def get_task_parked_key(task_uri):
+    """get the list of the tasks parked until the task `task_uri` is finished."""
+    return "%s:parked" % task_uri
+
+
+def new_lease_token():
+    """get a token to identify the owner of a task lease."""
+    return "%s:%d:%s" % (socket.gethostname(), os.getpid(), uuid.uuid4().hex)
+
+
+def add_to_task_l_and_acquire(task_uri, ssid, token, raw_uri=""):
     """
-    Add the ssid to the task list and return the qlen after add the ssid
+    Add the ssid to the task list and try to acquire the lease of the task
 
     we use redis database to make sure two identical tasks won't be pushed to rabbitmq repeatedly.
-    instead, different clients that propose the same request will be stored and responsed together
-    here we use a third-party lib : https://pypi.org/project/python-redis-lock/
+    instead, different clients that propose the same request will be stored and responsed together.
+    The task list carries a lease which is renewed by the processing worker(`TaskLease`).
+    If the lease expires, the worker is considered dead and the next identical request takes over the task.
 
     :param task_uri:
+    :param ssid:
+    :param token: identify the owner of the lease
+    :param raw_uri: the uri of the request before canonicalization, the requests merged only because of
+                    the canonicalization are counted in the `canonical_merged` metric
+    :return: 0 if the task is being processed, 1 if the task is acquired, 2 if the task is taken over
     """
-    redis_t = get_redis_connection()
-    with redis_lock.Lock(redis_t, "task-%s" % task_uri):
-        # use list structure in redis
-        # NOTE: When using list in redis, the results popped from the list is byte format.
-        # The client_ssid must be transformed to str.
-        redis_t.lpush(task_uri, ssid)
-        return redis_t.llen(task_uri)
+    # use list structure in redis
+    # NOTE: When using list in redis, the results popped from the list is byte format.
+    # The client_ssid must be transformed to str.
+    return get_redis_script(ADD_TASK_SCRIPT)(
+        keys=[task_uri, get_task_lease_key(task_uri), METRICS_KEY, get_task_raw_uris_key(task_uri)],
+        args=[ssid, token, int(C.task_lease_ttl * 1000), raw_uri],
+    )
+
+
+def take_over_task(task_uri, token):
+    """Take over the task if its lease has expired while the clients are still waiting for it.
+
+    :return: 0 if the task is being processed, 1 if the task has been finished, 2 if the task is taken over
+    """
+    return get_redis_script(TAKE_OVER_TASK_SCRIPT)(
+        keys=[task_uri, get_task_lease_key(task_uri), METRICS_KEY], args=[token, int(C.task_lease_ttl * 1000)]
+    )
 
 
 def pop_ssids_from_redis(task_uri):
     """get a task from redis database.
 
-    get all clients that propose a certain request and respond to them
+    get all clients that propose a certain request and respond to them, the lease of the task is released.
+    A client is listed once even if its task has been delivered more than once.
     """
-    redis_t = get_redis_connection()
-    with redis_lock.Lock(redis_t, "task-%s" % task_uri):
-        client_ssid_b_list = redis_t.lrange(task_uri, 0, -1)
-        redis_t.delete(task_uri)
-        client_ssid_list = [ssid.decode() for ssid in client_ssid_b_list]
-    return client_ssid_list
+    client_ssid_b_list = get_redis_script(POP_TASK_SCRIPT)(
+        keys=[task_uri, get_task_lease_key(task_uri), get_task_raw_uris_key(task_uri)]
+    )
+    return list(dict.fromkeys(ssid.decode() for ssid in client_ssid_b_list))
+
+
+class TaskLease(object):
+    """Renew the lease of a task in a background thread while the task is being processed.
+
+    .. code-block:: python
+
+        if add_to_task_l_and_acquire(task_uri, ssid, token):
+            with TaskLease(task_uri, token):
+                process(task)
+    """
+
+    def __init__(self, task_uri, token):
+        self.task_uri = task_uri
+        self.token = token
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._renew, daemon=True)
+
+    def _renew(self):
+        ttl = int(C.task_lease_ttl * 1000)
+        while not self._stop.wait(C.task_lease_ttl / 3):
+            renewed = get_redis_script(RENEW_TASK_SCRIPT)(
+                keys=[
+                    self.task_uri,
+                    get_task_lease_key(self.task_uri),
+                    get_task_raw_uris_key(self.task_uri),
+                    get_task_parked_key(self.task_uri),
+                ],
+                args=[self.token, ttl],
+            )
+            if not renewed:
+                # the task has been finished or taken over
+                break
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stop.set()
+        self._thread.join()
+
+
+TASK_LANES = ["light", "heavy"]
+
+
+def get_task_queue(lane=None):
+    """get the task queue of the lane.
+
+    If `C.task_routing` is disabled, all the tasks are published to `C.task_queue`.
+    """
+    if not C.task_routing or lane is None:
+        return C.task_queue
+    return "%s_%s" % (C.task_queue, lane)
+
+
+def get_shard_queue():
+    """get the queue of the shards of the feature tasks."""
+    return "%s_shard" % C.task_queue
+
+
+def get_node_queue(task_queue, node):
+    """get the queue of the tasks in `task_queue` routed to the data processor `node`."""
+    return "%s@%s" % (task_queue, node)
+
+
+def get_processor_node_id():
+    """get the id of the data processor node."""
+    return C.processor_node_id or socket.gethostname()
+
+
+def get_routed_task_queues():
+    """get the task queues of which the data processor nodes have their own queues."""
+    return [task_queue for task_queue in get_task_queues() if task_queue != get_shard_queue()]
+
+
+def get_task_queues():
+    """get all the task queues and the number of worker processes consuming each of them."""
+    if not C.task_routing:
+        task_queues = {C.task_queue: C.max_process}
+    else:
+        task_queues = {get_task_queue(lane): C.lane_max_process[lane] for lane in TASK_LANES}
+    if C.feature_shard_size:
+        # the shards have their own workers, so the feature tasks waiting for their shards can't starve them
+        task_queues[get_shard_queue()] = C.shard_max_process
+    return task_queues
 
 
 # data ####################
+DATA_VERSION_KEY = "qlib_server:data_version"
+DATA_UPDATE_CHANNEL = "qlib_server:data_updated"
+
+
+def get_data_version():
+    """get the version of the data, which is increased every time the data is updated."""
+    redis_t = get_redis_connection()
+    return int(redis_t.get(DATA_VERSION_KEY) or 0)
+
+
+def notify_data_updated():
+    """notify the server that the data and the caches have been updated.
+
+    The long-lived processes of the server compare the data version with the one they
+    have seen, and drop their in-memory data when it changes.
+    """
+    redis_t = get_redis_connection()
+    data_version = redis_t.incr(DATA_VERSION_KEY)
+    redis_t.publish(DATA_UPDATE_CHANNEL, data_version)
+    return data_version
+
+
+# get the result memo of the current data version in one round trip
+GET_RESULT_MEMO_SCRIPT = """
+local version = redis.call('GET', KEYS[1]) or '0'
+return redis.call('GET', ARGV[1] .. version .. ':' .. ARGV[2])
+"""
+RESULT_MEMO_PREFIX = "qlib_server:memo:"
+
+
+def get_result_memo(task_uri):
+    """get the memo of the result of a completed task.
+
+    :return: the json encoded result, None if there is no memo of the current data version
+    """
+    memo = get_redis_script(GET_RESULT_MEMO_SCRIPT)(keys=[DATA_VERSION_KEY], args=[RESULT_MEMO_PREFIX, task_uri])
+    return None if memo is None else memo.decode("utf-8")
+
+
+def set_result_memo(task_uri, data_version, result):
+    """memo the result of a completed task for `C.result_memo_ttl` seconds.
+
+    The memo is keyed by the data version, so it's invalid once the data is updated.
+    """
+    key = "%s%s:%s" % (RESULT_MEMO_PREFIX, data_version, task_uri)
+    get_redis_connection().set(key, json.dumps(result), ex=C.result_memo_ttl)
+
+
+def subscribe_data_update(callback):
+    """call `callback` in a background thread every time the data is updated.
+
+    :return: the thread running the subscription
+    """
+    redis_t = get_redis_connection()
+    pubsub = redis_t.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(**{DATA_UPDATE_CHANNEL: lambda message: callback()})
+    return pubsub.run_in_thread(sleep_time=1, daemon=True)
+
+
+def get_node_id():
+    """get the id of the request handler node."""
+    return C.node_id or "%s:%s" % (socket.gethostname(), C.flask_port)
+
+
+def get_reply_queue():
+    """get the queue of the messages to the clients of this request handler node.
+
+    If the request handlers share a socket.io message queue, any of them can respond to any client,
+    so they share `C.message_queue`. Otherwise each node has its own queue.
+    """
+    if C.socketio_message_queue:
+        return C.message_queue
+    return "%s_%s" % (C.message_queue, get_node_id())
+
+
+def group_ssids_by_reply_queue(ssids):
+    """Group the ssids popped from a task list by the queues of the messages to them.
+
+    The ssids of the tasks with a reply queue are saved as "<reply queue>|<ssid>".
+
+    :return: dict of reply queue and ssids
+    """
+    replies = {}
+    for ssid in ssids:
+        reply_queue, _, ssid = ssid.rpartition("|")
+        replies.setdefault(reply_queue or C.message_queue, []).append(ssid)
+    return replies
 
 
 # ################### Other ####################
+def normalize_time(t):
+    """Normalize a time in the request, so the same time in different formats is the same."""
+    if t is None or t == "None":
+        return None
+    return str(pd.Timestamp(t))
+
+
 def get_task_uri(task_type, task_body):
+    """get the canonical uri of a task.
+
+    The identical tasks are deduplicated by it, and the clients waiting for it are in the room named by it.
+
+        - the times are normalized, so "2020-01-01" and "2020-01-01 00:00:00" are the same time
+        - the instruments and fields of the feature tasks are normalized by qlib(sorted, deduplicated and
+          without spaces) and the times are ignored, because the dataset cache covers the whole calendar
+        - the streamed feature tasks keep the times and the order of the fields, which the streams depend on
+
+    .. note:: the fields are not lower-cased, because the columns of the dataset cache are named by them.
+    """
     if task_type == "calendar":
-        return hash_args(task_body)
+        return hash_args(
+            task_type,
+            normalize_time(task_body["start_time"]),
+            normalize_time(task_body["end_time"]),
+            task_body["freq"],
+            bool(task_body.get("future", False)),
+        )
     elif task_type == "instrument":
-        return hash_args(task_body)
+        return hash_args(
+            task_type,
+            task_body["instruments"],
+            normalize_time(task_body["start_time"]),
+            normalize_time(task_body["end_time"]),
+            task_body["freq"],
+            bool(task_body["as_list"]),
+        )
     elif task_type == "feature":
-        if isinstance(task_body["instruments"], tuple) or isinstance(task_body["instruments"], list):
-            instruments = sorted(list(task_body["instruments"]))
-        else:
-            if "market" in task_body["instruments"]:
-                instruments = task_body["instruments"]
-            else:
-                instruments = {k: sorted(v) for k, v in task_body["instruments"].items()}
-        fields = sorted(list([str(field).lower() for field in task_body["fields"]]))
-        return hash_args(instruments, fields, task_body["freq"].lower())
+        return DatasetD._uri(
+            task_body["instruments"],
+            task_body["fields"],
+            None,
+            None,
+            task_body["freq"],
+            int(task_body.get("disk_cache", 1)),
+        )
+    elif task_type == "feature_stream":
+        # the streamed feature tasks are answered with different events from the feature tasks, and each
+        # client is streamed the rows in its time range and the columns in its order of the fields
+        return "%s:stream:%s" % (
+            get_task_uri("feature", task_body),
+            hash_args(
+                normalize_time(task_body["start_time"]),
+                normalize_time(task_body["end_time"]),
+                list(task_body["fields"]),
+            ),
+        )
+    raise ValueError("Unknown task type %s" % task_type)
+
+
+def get_raw_task_uri(task_type, task_body):
+    """get the uri of a task before canonicalization."""
+    return hash_args(task_type, task_body)
+
+
+def get_process_rss():
+    """get the resident set size of current process in bytes."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        # not linux, fall back to the peak rss
+        import resource
+
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
 
 
 def hash_args(*args):
@@ -0,0 +1,101 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+from __future__ import division
+from __future__ import print_function
+
+import re
+import pickle
+from pathlib import Path
+
+from qlib.config import C as QC
+
+
+class SourceWatermark(object):
+    """The watermark of the raw data a cache is computed from.
+
+    The watermark is the latest mtime of the raw feature files(`features/<instrument>/<field>.<freq>.bin`)
+    of the instruments and the `$field`s of the cache, and of the instruments file if the instruments are a
+    market. If the watermark has not moved since the cache was updated, the cache is up to date even if the
+    calendar has been extended, since there is no new data of its instruments and fields.
+
+    The mtimes are memoized, so every raw file is checked at most once by a watermark instance.
+    """
+
+    # `$field` and `$$field`(the point-in-time data, which is not tracked)
+    FIELD_PATTERN = re.compile(r"\$(\$?)(\w+)")
+
+    def __init__(self, freq="day"):
+        self.freq = freq
+        self.data_uri = Path(QC.dpm.get_data_uri(freq))
+        self._mtimes = {}
+        self._markets = {}
+
+    def get_mtime(self, path):
+        if path not in self._mtimes:
+            try:
+                self._mtimes[path] = path.stat().st_mtime
+            except FileNotFoundError:
+                self._mtimes[path] = 0.0
+        return self._mtimes[path]
+
+    def get_raw_fields(self, fields):
+        """Get the raw fields of the expressions, None if any of them is not tracked."""
+        raw_fields = set()
+        for field in fields:
+            for pit, name in self.FIELD_PATTERN.findall(field):
+                if pit:
+                    return None
+                raw_fields.add(name.lower())
+        return raw_fields
+
+    def get_market_instruments(self, market):
+        if market not in self._markets:
+            from qlib.data import D
+
+            # all the instruments ever in the market, the filters are not applied
+            self._markets[market] = D.list_instruments(
+                {"market": market, "filter_pipe": []}, freq=self.freq, as_list=True
+            )
+        return self._markets[market]
+
+    def of_features(self, instruments, fields):
+        raw_fields = self.get_raw_fields(fields)
+        if raw_fields is None:
+            return None
+        return max(
+            [
+                self.get_mtime(self.data_uri.joinpath("features", inst.lower(), f"{field}.{self.freq.lower()}.bin"))
+                for inst in instruments
+                for field in raw_fields
+            ],
+            default=0.0,
+        )
+
+    def of_expression(self, info):
+        return self.of_features([info["instrument"]], [info["field"]])
+
+    def of_dataset(self, info):
+        instruments = info["instruments"]
+        if isinstance(instruments, (list, tuple)):
+            return self.of_features(instruments, info["fields"])
+        if isinstance(instruments, dict) and "market" in instruments:
+            market = instruments["market"]
+            watermark = self.of_features(self.get_market_instruments(market), info["fields"])
+            if watermark is None:
+                return None
+            return max(watermark, self.get_mtime(self.data_uri.joinpath("instruments", f"{market.lower()}.txt")))
+        # the instruments with the time spans are not tracked
+        return None
+
+    def get(self, kind, cache_path):
+        """Get the watermark of the raw data of a cache, None if it can't be tracked.
+
+        :param kind: "expression" or "dataset"
+        """
+        try:
+            with Path(cache_path).with_suffix(".meta").open("rb") as f:
+                info = pickle.load(f)["info"]
+            return self.of_expression(info) if kind == "expression" else self.of_dataset(info)
+        except Exception:
+            return None
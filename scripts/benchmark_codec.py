@@ -0,0 +1,80 @@
+import yaml
+import timeit
+import argparse
+from pathlib import Path
+
+from qlib_server.config import init, C
+from qlib_server import codec
+
+# read config for qlib-server
+parser = argparse.ArgumentParser()
+parser.add_argument('-c', '--config', help="config file path",
+                    default=Path(__file__).parent.parent / 'config_template.yaml')
+parser.add_argument('-m', '--market', help="the market of the instrument payloads", default='all')
+parser.add_argument('-n', '--number', help="the number of times each payload is encoded and decoded",
+                    type=int, default=20)
+args = parser.parse_args()
+
+
+def get_payloads():
+    """Build the messages of real calendar, instrument and feature tasks."""
+    from qlib.data import D
+
+    calendar = [str(c) for c in D.calendar(freq='day')]
+    spans = D.list_instruments(D.instruments(args.market), freq='day', as_list=False)
+    spans = {i: [(str(s), str(e)) for s, e in t] for i, t in spans.items()}
+    fields = ['$close', '$open', '$high', '$low', '$volume', 'Ref($close, 1)/$close - 1']
+
+    def message(message_type, data):
+        return {'type': message_type, 'data': data, 'ssids': ['0' * 20], 'status': 0, 'detailed_info': None}
+
+    return {
+        'calendar message': message('calendar', calendar),
+        'instrument list message': message('instrument', list(spans)),
+        'instrument dict message': message('instrument', spans),
+        'feature task': {
+            'meta': {'type': 'feature', 'ssid': '0' * 20},
+            'args': {'instruments': list(spans), 'fields': fields, 'start_time': calendar[0],
+                     'end_time': calendar[-1], 'freq': 'day', 'disk_cache': 1},
+        },
+    }
+
+
+def benchmark(payloads):
+    """Benchmark the codecs the way the payloads are published.
+
+    The tasks are encoded by `encode`, the messages by `encode_message` and decoded by `decode_message`
+    as the responders do.
+    """
+    settings = [('json', 'json', 0), ('msgpack', 'msgpack', 0)]
+    if codec.zstandard is not None:
+        settings.append(('msgpack+zstd', 'msgpack', 1))
+    print('%-25s %-15s %12s %12s %12s' % ('payload', 'codec', 'size(bytes)', 'encode(ms)', 'decode(ms)'))
+    for name, payload in payloads.items():
+        for codec_name, queue_codec, threshold in settings:
+            C.queue_compress_threshold = threshold
+            if 'data' in payload:
+                header = {k: v for k, v in payload.items() if k != 'data'}
+
+                def encode():
+                    return codec.encode_message(header, payload['data'], queue_codec)
+
+                decode = codec.decode_message
+            else:
+
+                def encode():
+                    return codec.encode(payload, queue_codec)
+
+                decode = codec.decode
+            data = encode()
+            encode_time = timeit.timeit(encode, number=args.number)
+            decode_time = timeit.timeit(lambda: decode(data), number=args.number)
+            print('%-25s %-15s %12d %12.3f %12.3f' % (
+                name, codec_name, len(data), encode_time / args.number * 1000, decode_time / args.number * 1000))
+
+
+if __name__ == '__main__':
+    with open(args.config) as f:
+        config = yaml.load(f, Loader=yaml.FullLoader)
+    init(config, logging_config=config['logging_config'])
+    benchmark(get_payloads())
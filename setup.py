@@ -32,7 +32,10 @@ if not _QLIB_INSTALLED:
 # What packages are required for this module to be executed?
 REQUIRED = [
     "Flask>=1.0.2",
-    "Flask-SocketIO>=3.1.2",
+    # emitting `to` a list of session ids needs Flask-SocketIO>=5.0.1(the `to` argument) and
+    # python-socketio>=5.6.0(a list of rooms)
+    "Flask-SocketIO>=5.0.1",
+    "python-socketio>=5.6.0",
     "gevent<23",
     "pika>=0.12.0",
     "redis>=3.0.1",
@@ -48,6 +51,14 @@ REQUIRED = [
     "wsproto<1.2",
 ]
 
+# What packages are optional?
+EXTRAS = {
+    # the asyncio request handler, `AsyncServer.enter_room` is a coroutine since python-socketio 5.10.0
+    "async": ["python-socketio>=5.10.0", "uvicorn", "aio-pika>=6.0", "redis>=4.2"],
+    # the msgpack codec of the queues
+    "msgpack": ["msgpack>=1.0", "zstandard"],
+}
+
 here = os.path.abspath(os.path.dirname(__file__))
 
 with io.open(os.path.join(here, "README.md"), encoding="utf-8") as f:
@@ -68,6 +79,7 @@ setup(
     },
     ext_modules=[],
     install_requires=REQUIRED,
+    extras_require=EXTRAS,
     include_package_data=True,
     classifiers=[
         # Trove classifiers